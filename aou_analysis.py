@@ -1,15 +1,18 @@
 import os
 import glob
 import csv
+import json
 import uuid
 import pprint as pp
 from collections import Counter, defaultdict
 import pandas as pd
 import numpy as np
-from functools import reduce
 
 import omop_analyze
 import fhir_analyze
+import profiling
+from sketches import HeavyHitters
+from fhir_analyze import NO_DATA, convert_vocabulary, converter, fetch_at_path, path_for_resource
 
 # Helper functions:
 def configure_tables():
@@ -25,34 +28,6 @@ pd.DataFrame.merge_multi = merge_multi
 def export_df(df, filename):
     df.to_csv(path_or_buf=filename)
 
-def path_for_resource(resource):
-    resource_type = resource['resourceType']
-    code_paths = {
-        #'OperationOutcome': ['details', 'coding'],
-        'OperationOutcome': ['issue', 'details', 'coding'],
-        'MedicationOrder': ['medicationCodeableConcept', 'coding'], # no idea what I actually need here
-        'MedicationStatement': ['medicationCodeableConcept', 'coding'],
-        'AllergyIntolerance': ['substance', 'coding'],
-        'Observation': ['code', 'coding'], #code, coding
-        'Immunization': ['vaccineCode', 'coding'],
-        'Condition': ['code', 'coding'], #code, coding
-        'DocumentReference': ['class', 'coding'],
-        'Procedure': ['code', 'coding'],
-        'Patient': ['code', 'coding'],
-    }
-    return code_paths[resource_type]
-
-def fetch_at_path(resource, path):
-    if type(path) == type(''):
-        path = path.split('.')
-    def walk(data, k):
-        if isinstance(data, dict):
-            return data.get(k)
-        elif isinstance(data, list):
-            return [reduce(walk, [k], el) for el in data]
-        return None
-    return reduce(walk, path, resource)
-
 STATUS_WHITELIST = [
     'status',
     'system',
@@ -162,28 +137,22 @@ def traverse(resource, node, name=None):
         node.count[resource] += 1
     return node
 
-CODE_COLUMNS = {
-    'condition.csv': ('condition_concept_id', 'condition_source_concept_id'),
-    'observation.csv': ('observation_concept_id', 'observation_source_concept_id'),
-    'procedure.csv': ('procedure_concept_id', 'procedure_source_concept_id'),
-    'drug_summary.csv': ('drug_concept_id', 'drug_source_concept_id'),
-    'drug.csv': ('drug_concept_id', 'drug_source_concept_id'),
-    'measurement.csv': ('measurement_concept_id', 'measurement_source_concept_id'),
-}
+CODE_COLUMNS = omop_analyze.CODE_COLUMNS
 
 def csv_to_dicts(filename):
     with open(filename, encoding="utf8") as csv_file:
         items = (filename, list(csv.DictReader(csv_file, delimiter="\t")))
     return items
 
-def init_omop_concepts():
-    vocab = csv_to_dicts('VOCABULARY.csv')[1]
+@profiling.stage('init_omop_concepts')
+def init_omop_concepts(path='.'):
+    vocab = csv_to_dicts(os.path.join(path, 'VOCABULARY.csv'))[1]
     vocab_df = pd.DataFrame(vocab)
-    concept = csv_to_dicts('CONCEPT.csv')[1]
+    concept = csv_to_dicts(os.path.join(path, 'CONCEPT.csv'))[1]
     concept_df = pd.DataFrame(concept)
-    concept_cpt4 = csv_to_dicts('CONCEPT_CPT4.csv')[1]
+    concept_cpt4 = csv_to_dicts(os.path.join(path, 'CONCEPT_CPT4.csv'))[1]
     cpt4_df = pd.DataFrame(concept_cpt4)
-    concept_aouppi = csv_to_dicts('CONCEPT_AOUPPI.csv')[1]
+    concept_aouppi = csv_to_dicts(os.path.join(path, 'CONCEPT_AOUPPI.csv'))[1]
     aouppi_df = pd.DataFrame(concept_aouppi)
 
     vocab_df.set_index(['vocabulary_id',], inplace=True)
@@ -192,15 +161,19 @@ def init_omop_concepts():
     merged_concept_df = concept_df.append([cpt4_df, aouppi_df])
     return merged_concept_df
 
-concept_table = init_omop_concepts()
+# directory with VOCABULARY.csv and the CONCEPT csvs, the working directory by default
+CONCEPT_PATH = os.environ.get('AOU_CONCEPT_PATH', '.')
+concept_table = init_omop_concepts(CONCEPT_PATH)
 
-NO_DATA = 'Empty raw value'
 MISSING_CONCEPT = 'Missing concept'
 NO_MATCHING_CONCEPT = 'No standardized concept'
 NO_MATCHING_DISPLAY = 'No standardized display'
 PARSE_ERROR = 'Error parsing'
 
 missing_concept_codes = set()
+# FHIR systems convert_vocabulary had no rule for, with how often they were seen;
+# print them once with fhir_analyze.vocabulary_resolver.report()
+missing_systems = fhir_analyze.vocabulary_resolver.unknown
 
 def get_fhir_standardized_concept(fhir_coding):
     standardized_concept = concept_table.iloc[
@@ -268,8 +241,11 @@ class Memoize:
         self.memo = {}
 
     def __call__(self, *args):
+        profiling.count(self.fn.__name__ + '_lookups')
         if args not in self.memo:
             self.memo[args] = self.fn(*args)
+        else:
+            profiling.count(self.fn.__name__ + '_cache_hits')
         return self.memo[args]
 
 @Memoize
@@ -322,49 +298,11 @@ def concept_code_query(df, system, code):
         print(e)
     return concept
 
-converter = {
-    NO_DATA: NO_DATA,
-    'http://loinc.org': 'LOINC',
-    'http://snomed.info/sct': 'SNOMED',
-    'http://hl7.org/fhir/sid/icd-9-cm/diagnosis': 'ICD9CM',
-    'http://www.ama-assn.org/go/cpt': 'CPT4',
-    'http://hl7.org/fhir/sid/icd-9-cm': 'ICD9CM',
-    'http://hl7.org/fhir/sid/icd-10-cm': 'ICD10CM',
-    'urn:oid:2.16.840.1.113883.6.90': 'ICD10CM',
-    'urn:oid:2.16.840.1.113883.6.14': 'HCPCS',
-    'http://www.nlm.nih.gov/research/umls/rxnorm': 'RxNorm',
-    'http://hl7.org/fhir/sid/ndc': 'NDC',
-    'http://hl7.org/fhir/ndfrt': 'None',
-    'http://fdasis.nlm.nih.gov': 'None',
-    'http://hl7.org/fhir/sid/cvx': 'CVX',
-    'http://hl7.org/fhir/observation-category': 'Observation Type',
-    'https://apis.followmyhealth.com/fhir/id/translation': 'None',
-    'http://argonautwiki.hl7.org/extension-codes': 'None',
-    'http://hl7.org/fhir/condition-category': 'None',
-    'http://argonaut.hl7.org': 'None',
-    # these are codes for EPIC clients. I need to figure out what the suffix means.
-    'urn:oid:1.2.840.114350.1.13.71.2.7.2.696580': 'None',
-    'urn:oid:1.2.840.114350.1.13.202.2.7.2.696580': 'None',
-    'urn:oid:1.2.840.114350.1.13.324.2.7.2.696580': 'None',
-    'urn:oid:1.2.840.114350.1.13.362.2.7.2.696580': 'None',
-    'urn:oid:1.2.840.114350.1.13.71.2.7.2.657369': 'None',
-    'urn:oid:1.2.840.114350.1.13.202.2.7.2.657369': 'None',
-    'urn:oid:1.2.840.114350.1.13.324.2.7.2.657369': 'None',
-    'urn:oid:1.2.840.114350.1.13.362.2.7.2.657369': 'None',
-    'urn:oid:1.2.840.114350.1.13.232.2.7.2.657369': 'None',
-}
-
-def convert_vocabulary(system):
-    try:
-        return converter[system]
-    except KeyError:
-        print("found a missing system:", system)
-        return system
-
 def omop_raw_coding(row, table):
     concepts = []
     for column in CODE_COLUMNS[table]:
-        if column in row.keys():
+        # missing, or None for a short csv row
+        if row.get(column) is not None:
             concepts.append(row[column])
         else:
             concepts.append('None')
@@ -409,14 +347,20 @@ def compose_vocab_df(vocab):
     vocab4_df = vocab3_df.drop(columns=[0,1])
     return vocab4_df
 
+@profiling.stage('most_common_synonym')
 def most_common_synonym(coding_sets):
+    # coding_sets is either a list of coding sets or a Counter of
+    # frozenset -> number of times that coding set was seen.
     coding2hash = {}
     hash2set = {}
     most_common = Counter()
-    for i, coding_set in enumerate(coding_sets):
-        #print("set", i, "of ", len(coding_sets), "with a length of", len(coding_set))
+    if isinstance(coding_sets, Counter):
+        weighted_sets = coding_sets.items()
+    else:
+        weighted_sets = ((coding_set, 1) for coding_set in coding_sets)
+    for coding_set, seen in weighted_sets:
         for coding in coding_set:
-            most_common[coding] += 1
+            most_common[coding] += seen
         if len(coding_set) < 2:
             continue
         current_hash = None
@@ -457,7 +401,7 @@ def most_common_synonym(coding_sets):
             #new set! easy peasy.
             new_hash = uuid.uuid4()
             #print("new synonym set found", new_hash)
-            hash2set[new_hash] = coding_set
+            hash2set[new_hash] = set(coding_set)
             coding2hash.update({coding:new_hash for coding in coding_set})
     # all synonyms are now combined.
     #print("now generating mapping between coding and most common synonym")
@@ -473,14 +417,15 @@ def most_common_synonym(coding_sets):
 
 # Report Functions - FHIR
 def fhir_plot_category_counts(fhir_people):
-    s4s_datatype_totals = {person:{title:len(items) for (title, items) in datatype.items()} for (person, datatype) in fhir_people.items()}
+    s4s_datatype_totals = {person:{title:len(items) for (title, items) in datatype.items()} for (person, datatype) in fhir_analyze.iter_people(fhir_people)}
     s4s_df = pd.DataFrame(s4s_datatype_totals).transpose()
     return s4s_df
 
+@profiling.stage('code_system_counts')
 def code_system_counts(fhir_people):
     # Count of code *systems* for each data category. E.g., fraction of SNOMED vs LOINC vs Other codes found in Conditions.
     coding_paths = {}
-    for person, documents in fhir_people.items():
+    for person, documents in fhir_analyze.iter_people(fhir_people):
         for document, data in documents.items():
             if document not in coding_paths:
                 coding_paths[document] = Counter()
@@ -494,17 +439,26 @@ def code_system_counts(fhir_people):
                             pass
     return coding_paths
 
+@profiling.stage('coding_counts')
 def coding_counts(fhir_people):
     # Count of codings for each data category.
+    concept_table.set_index(['concept_code', 'vocabulary_id',], inplace=True)
+    return coding_counts_from_partial(coding_counts_partial(fhir_people))
+
+def coding_counts_partial(fhir_people):
+    # The counting half of coding_counts: first codings, distinct coding sets
+    # and display values per category. Partials of disjoint groups of people
+    # combine with merge_coding_counts.
     coding_paths = {}
     coding_sets = {}
     display_codes = {}
-    concept_table.set_index(['concept_code', 'vocabulary_id',], inplace=True)
-    for person, documents in list(fhir_people.items()):
+    for person, documents in fhir_analyze.iter_people(fhir_people):
         for document, data in documents.items():
             if document not in coding_paths:
                 coding_paths[document] = Counter()
-                coding_sets[document] = []
+                # distinct coding sets and how often each was seen, so memory
+                # grows with distinct codings rather than with entries
+                coding_sets[document] = Counter()
             for entry in data:
                 fetched = fetch_at_path(entry, path_for_resource(entry))
                 if fetched:
@@ -534,7 +488,26 @@ def coding_counts(fhir_people):
                             coding_paths[document][code_hash] += 1
                         coding_set.add(code_hash)
                         display_codes[code_hash] = coding
-                    coding_sets[document].append(coding_set)
+                    coding_sets[document][frozenset(coding_set)] += 1
+    return {
+        'paths': coding_paths,
+        'sets': coding_sets,
+        'display': display_codes,
+    }
+
+def merge_coding_counts(partial, other):
+    # Add the coding_counts_partial `other` into `partial`, in place.
+    for key in ['paths', 'sets']:
+        for document, counter in other[key].items():
+            partial[key].setdefault(document, Counter()).update(counter)
+    partial['display'].update(other['display'])
+    return partial
+
+def coding_counts_from_partial(partial):
+    # The synonym half of coding_counts.
+    coding_paths = partial['paths']
+    coding_sets = partial['sets']
+    display_codes = partial['display']
     #work out the most common synonyms
     most_common_coding = {}
     synonym_sets = {}
@@ -572,6 +545,138 @@ def coding_counts(fhir_people):
         'display': display_codes,
     }
 
+def approximate_coding_counts(fhir_people, k=20):
+    # Approximate top codings (first coding of each entry, as in coding_counts)
+    # and code systems for each data category, without the display and concept
+    # lookups. Each participant's codings are counted exactly, then go into
+    # HeavyHitters summaries of bounded size no matter how many distinct
+    # codings there are; use coding_counts when those fit.
+    sketches = {}
+    for person, documents in fhir_analyze.iter_people(fhir_people):
+        for document, data in documents.items():
+            if document not in sketches:
+                sketches[document] = {'codings': HeavyHitters(k), 'systems': HeavyHitters(k)}
+            codings = []
+            systems = []
+            for entry in data:
+                for i, f in enumerate(fhir_analyze.codings_for_resource(entry)):
+                    systems.append(f.get('system'))
+                    if i == 0:
+                        codings.append(f.get('system', NO_DATA)+' '+f.get('code', NO_DATA))
+            sketches[document]['codings'].update(codings)
+            sketches[document]['systems'].update(systems)
+    return {
+        document: {name: sketch.summary() for name, sketch in document_sketches.items()}
+        for document, document_sketches in sketches.items()
+    }
+
+def extension_value(value):
+    # hashable, readable key for an extension's value[x]
+    if isinstance(value, dict):
+        if 'coding' in value:
+            codings = [c for c in value['coding'] if isinstance(c, dict)]
+            if codings:
+                value = codings[0]
+            else:
+                return value.get('text', NO_DATA)
+        if 'code' in value or 'system' in value:
+            return value.get('system', NO_DATA)+' '+value.get('code', NO_DATA)
+        if 'reference' in value:
+            return value['reference']
+        if 'text' in value:
+            # a CodeableConcept with just text, keyed like one with empty codings
+            return value['text']
+        return json.dumps(value, sort_keys=True)
+    return str(value)
+
+def iter_extensions(extensions, parent=None):
+    # (url, value type, value) for each extension, including nested ones,
+    # whose url is prefixed with their parent's.
+    for extension in extensions or []:
+        if not isinstance(extension, dict):
+            continue
+        url = extension.get('url', NO_DATA)
+        if parent:
+            url = parent + ' > ' + url
+        # extensions carry a single value[x], or nested extensions instead
+        value_type = next((key for key in extension if key.startswith('value')), None)
+        yield url, value_type, extension_value(extension[value_type]) if value_type else None
+        yield from iter_extensions(extension.get('extension'), url)
+
+class ExtensionProfile:
+    # Extension urls, value types and top values per category, built while
+    # participants stream by. Url and value type counts are exact. The values
+    # of each url are counted exactly up to `capacity` distinct ones (a few
+    # hundred bytes for the usual handful of codes); urls with more keep a
+    # HeavyHitters summary of at most `capacity` values, so memory does not
+    # grow with the cohort. Profiles of disjoint groups of people combine
+    # with merge.
+    def __init__(self, k=20, capacity=1000):
+        self.k = k
+        self.capacity = capacity
+        self.urls = {}
+        self.value_types = {}
+        self.values = {}
+
+    def add_person(self, documents):
+        for document, data in documents.items():
+            urls = self.urls.setdefault(document, Counter())
+            value_types = self.value_types.setdefault(document, {})
+            values = Counter()
+            for entry in data:
+                for url, value_type, value in iter_extensions(fetch_at_path(entry, ['extension'])):
+                    urls[url] += 1
+                    if value_type is None:
+                        continue
+                    value_types.setdefault(url, Counter())[value_type] += 1
+                    values[url, value] += 1
+            # count the participant exactly, the sketches only see distinct values
+            document_values = self.values.setdefault(document, {})
+            for (url, value), count in values.items():
+                if url not in document_values:
+                    document_values[url] = HeavyHitters(self.k, capacity=self.capacity)
+                document_values[url].add(value, count)
+
+    def update(self, fhir_people):
+        for person, documents in fhir_analyze.iter_people(fhir_people):
+            self.add_person(documents)
+        return self
+
+    def merge(self, other):
+        for document, urls in other.urls.items():
+            self.urls.setdefault(document, Counter()).update(urls)
+        for document, value_types in other.value_types.items():
+            for url, counter in value_types.items():
+                self.value_types.setdefault(document, {}).setdefault(url, Counter()).update(counter)
+        for document, values in other.values.items():
+            for url, sketch in values.items():
+                document_values = self.values.setdefault(document, {})
+                if url in document_values:
+                    document_values[url].merge(sketch)
+                else:
+                    # a copy, merging into this profile later must not change other
+                    document_values[url] = sketch.copy()
+        return self
+
+    def summary(self, n=None):
+        return {
+            document: {
+                url: {
+                    'count': count,
+                    'value_types': dict(self.value_types.get(document, {}).get(url, {})),
+                    'values': self.values[document][url].summary(n) if url in self.values.get(document, {}) else None,
+                }
+                for url, count in urls.most_common()
+            }
+            for document, urls in self.urls.items()
+        }
+
+@profiling.stage('extension_profile')
+def extension_profile(fhir_people, k=20, capacity=1000):
+    # Streaming replacement for collecting every entry's extensions into
+    # DataFrames; takes a traverse_directory dict or an iter_participants iterator.
+    return ExtensionProfile(k, capacity).update(fhir_people)
+
 def print_synonym_sets(synonyms, display_names):
     for key, value in synonyms.items():
         most_common = display_names[key]['display']
@@ -601,34 +706,73 @@ def omop_plot_category_counts(omop_people, categories):
     omop_df_types = pd.DataFrame(omop_data_types_per_person, index=omop_people.values())
     return omop_df_types
 
+def omop_concept_pair_counts(omop_people):
+    # Count the raw (concept_id, source_concept_id) pairs of each table in one
+    # pass, so concept resolution only has to happen once per distinct pair.
+    pairs = {}
+    for person, tables in omop_people.items():
+        for filename, incidents in tables.items():
+            if filename not in pairs:
+                pairs[filename] = Counter()
+            columns = CODE_COLUMNS[filename]
+            pairs[filename].update(
+                tuple(incident.get(column) for column in columns)
+                for incident in incidents
+            )
+    return pairs
+
+def omop_pair_to_row(pair, table):
+    # rebuild the minimal row omop_raw_coding/omop_concept_to_coding expect.
+    # Missing values stay None, which the concept lookup treats as unmatched.
+    return dict(zip(CODE_COLUMNS[table], pair))
+
+@profiling.stage('omop_system_counts')
 def omop_system_counts(omop_people):
     # Count of standardized code *systems* for each OMOP data type. E.g., fraction of SNOMED vs LOINC vs Other codes found in condition_concept_id.
+    return omop_system_counts_for_pairs(omop_concept_pair_counts(omop_people))
+
+def omop_system_counts_for_pairs(pair_counts):
+    # omop_system_counts from (merged) omop_concept_pair_counts.
     systems = {}
-    for person, tables in omop_people.items():
-        for filename, incidents in tables.items():
-            if not filename in systems:
-                systems[filename] = Counter()
-            for incident in incidents:
-                coding = list(omop_concept_to_coding(incident, filename))
-                try:
-                    systems[filename][coding[0]['system']] += 1
-                except KeyError:
-                    systems[filename]['None'] += 1
+    for filename, pairs in pair_counts.items():
+        systems[filename] = Counter()
+        for pair, count in pairs.items():
+            coding = list(omop_concept_to_coding(omop_pair_to_row(pair, filename), filename))
+            try:
+                systems[filename][coding[0]['system']] += count
+            except KeyError:
+                systems[filename]['None'] += count
     return systems
 
+@profiling.stage('omop_coding_counts')
 def omop_coding_counts(omop_people):
+    return omop_coding_counts_for_pairs(omop_concept_pair_counts(omop_people))
+
+def omop_coding_counts_for_pairs(pair_counts):
+    # omop_coding_counts from (merged) omop_concept_pair_counts.
     codes = {}
     standardized_codings = {}
+    for filename, pairs in pair_counts.items():
+        codes[filename] = Counter()
+        for pair, count in pairs.items():
+            row = omop_pair_to_row(pair, filename)
+            coding = omop_raw_coding(row, filename)
+            if coding not in standardized_codings:
+                standardized_codings[coding] = list(omop_concept_to_coding(row, filename))
+            codes[filename][coding] += count
+    return codes, standardized_codings
+
+def approximate_omop_coding_counts(omop_people, k=20):
+    # Approximate top raw concept id pairs per OMOP table, see approximate_coding_counts.
+    sketches = {}
     for person, tables in omop_people.items():
         for filename, incidents in tables.items():
-            if filename not in codes:
-                codes[filename] = Counter()
-            for incident in incidents:
-                coding = omop_raw_coding(incident, filename)
-                standardized_codings[coding] = list(omop_concept_to_coding(incident, filename))
-                codes[filename][coding] += 1
-    return codes, standardized_codings
+            if filename not in sketches:
+                sketches[filename] = HeavyHitters(k)
+            sketches[filename].update(omop_raw_coding(incident, filename) for incident in incidents)
+    return {filename: sketch.summary() for filename, sketch in sketches.items()}
 
+@profiling.stage('omop_status_counts')
 def omop_status_counts(omop_data_dump, status_flags):
     omop_status_counters = {}
     for csv, table in omop_data_dump:
@@ -649,6 +793,7 @@ def omop_status_counts(omop_data_dump, status_flags):
 
 # Comparisons
 
+@profiling.stage('compare_per_patient')
 def compare_per_patient(fhir_patients, omop_patients):
     fhir_df = pd.DataFrame(fhir_patients)
     category_sums_df = fhir_df.apply(lambda x: x.apply(lambda y: len(y) if type(y) == type([]) else y))
@@ -692,3 +837,40 @@ def compare_condition_per_patient(fhir_patients, omop_patients):
     condition_df.sort_values('PROBLEMS', ascending=False, inplace=True)
     condition_df.index = pd.RangeIndex(len(condition_df))
     return condition_df
+
+# S4S categories and the OMOP tables the same data ends up in, as paired by
+# compare_condition_per_patient / compare_medication_per_patient
+COMPARED_CATEGORIES = {
+    'Condition': (['PROBLEMS'], ['condition.csv']),
+    'Medication': (
+        ['MEDICATION_ORDER', 'MEDICATION_STATEMENT', 'MEDICATION_DISPENSE', 'MEDICATION_ADMINISTRATION'],
+        ['drug.csv'],
+    ),
+    'Procedure': (['PROCEDURE'], ['procedure.csv']),
+    'Measurement': (['LAB', 'VITAL'], ['measurement.csv']),
+    'Observation': (['SMOKING_STATUS'], ['observation.csv']),
+}
+
+def compare_participant(index, person_id):
+    # S4S entries next to OMOP rows of the same kind for one participant,
+    # loaded on demand from a `participant_index.ParticipantIndex`.
+    fhir = index.fhir(person_id)
+    omop = index.omop(person_id)
+    compare_df = pd.DataFrame(
+        [
+            [
+                sum(len(fhir.get(category, [])) for category in categories),
+                sum(len(omop.get(table, [])) for table in tables),
+            ]
+            for categories, tables in COMPARED_CATEGORIES.values()
+        ],
+        index=list(COMPARED_CATEGORIES),
+        columns=['FHIR', 'OMOP'],
+    )
+    compare_df.index.name = person_id
+    return compare_df
+
+def page_participants(index, page=0, page_size=10):
+    # one page of side-by-side participant views, for paging through a cohort
+    person_ids = index.person_ids()[page * page_size:(page + 1) * page_size]
+    return {person_id: compare_participant(index, person_id) for person_id in person_ids}
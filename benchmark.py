@@ -0,0 +1,263 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import fhir_analyze
+import omop_analyze
+from pipeline import load_aou_analysis
+import synthetic_data
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-d',
+        '--data',
+        help='Existing synthetic data set to use instead of generating one',
+        default=None,
+    )
+    synthetic_data.add_scale_arguments(parser)
+    parser.add_argument(
+        '--repeat',
+        help='Runs per benchmark, the fastest one is reported',
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        '-b',
+        '--benchmark',
+        help='Only run the named benchmark (can be repeated)',
+        action='append',
+        default=[],
+    )
+    parser.add_argument(
+        '--history',
+        help='JSON lines file results are appended to and compared against',
+        default='benchmark_history.jsonl',
+    )
+    parser.add_argument(
+        '--threshold',
+        help='Slowdown relative to the last run at the same scale reported as a regression',
+        default=0.1,
+        type=float,
+    )
+
+    return parser.parse_args()
+
+
+def time_it(fn, repeat=3, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def quiet(fn, *args, **kwargs):
+    # most entry points print progress; keep the benchmark output readable
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+
+
+def listdir_resource_files(path):
+    # the enumeration used before switching to scandir: glob for participants,
+    # then listdir and an isdir stat per entry, with the same per-query work
+    for directory in glob.glob(os.path.join(path, '*', 'SyncForScience')):
+        for subdir in os.listdir(directory):
+            subdir_path = os.path.join(directory, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            try:
+                with open(os.path.join(subdir_path, 'log.json')) as f:
+                    log_data = json.load(f)
+                for query in log_data['query']:
+                    if query['status'] != 200:
+                        continue
+                    filename = query['response']
+                    type_ = filename[:filename.index('.')]
+                    m = re.match(
+                        fhir_analyze.BASE_URI_TEMPLATE.format(fhir_analyze.FILE_TYPE_MAPPING[type_]),
+                        query['request']
+                    )
+                    m.group('base_uri')
+                    logging.debug('Found {} of type {}'.format(
+                        os.path.join(subdir_path, filename), type_
+                    ))
+                    yield os.path.join(subdir_path, filename)
+            except (IOError, ValueError, KeyError):
+                continue
+
+
+def scandir_resource_files(path):
+    for person_id, directory in fhir_analyze.participant_directories(path):
+        for type_, filename, base_uri in fhir_analyze.find_resource_files(directory):
+            yield filename
+
+
+def discovery_rates(data, repeat=3):
+    """Resource files discovered per second by the old listdir/glob enumeration
+    and the current scandir one.
+    """
+    fhir_path = os.path.join(data, 'fhir', 'Participant')
+    rates = {}
+    for name, discover in [
+        ('listdir', listdir_resource_files),
+        ('scandir', scandir_resource_files),
+    ]:
+        files = sum(1 for _ in discover(fhir_path))
+        seconds = time_it(lambda: sum(1 for _ in discover(fhir_path)), repeat)
+        rates[name] = files / seconds if seconds else None
+    return rates
+
+
+def benchmarks(data):
+    """Mapping of benchmark name to (setup, function) for the main entry points,
+    run against the synthetic data set in `data`.
+    """
+    fhir_path = os.path.join(data, 'fhir', 'Participant')
+    omop_path = os.path.join(data, 'omop')
+    state = {}
+
+    def fhir_main():
+        argv = sys.argv
+        sys.argv = ['fhir_analyze.py', '-p', fhir_path]
+        try:
+            quiet(fhir_analyze.main)
+        finally:
+            sys.argv = argv
+
+    def s4s_people():
+        if 'people' not in state:
+            state['people'] = quiet(fhir_analyze.traverse_directory, fhir_path)
+        return state['people']
+
+    def aou():
+        if 'aou' not in state:
+            state['aou'] = quiet(load_aou_analysis, data)
+        return state['aou']
+
+    def reset_concept_index():
+        # coding_counts re-indexes the shared concept table in place
+        concept_table = aou().concept_table
+        if 'concept_code' not in concept_table.columns:
+            concept_table.reset_index(inplace=True)
+        s4s_people()
+
+    def coding_sets():
+        if 'coding_sets' not in state:
+            people = s4s_people()
+            state['coding_sets'] = [
+                {' '.join([str(f.get('system')), str(f.get('code'))])
+                 for f in fhir_analyze.codings_for_resource(entry)}
+                for documents in people.values()
+                for entries in documents.values()
+                for entry in entries
+            ]
+        return state['coding_sets']
+
+    return {
+        'fhir_analyze.main': (None, fhir_main),
+        'traverse_directory': (None, lambda: quiet(fhir_analyze.traverse_directory, fhir_path)),
+        'traverse_directory.prefetch': (None, lambda: quiet(
+            fhir_analyze.traverse_directory, fhir_path, workers=8
+        )),
+        'parse_omop': (None, lambda: quiet(omop_analyze.parse_omop, omop_path)),
+        'coding_counts': (reset_concept_index, lambda: quiet(aou().coding_counts, s4s_people())),
+        'most_common_synonym': (coding_sets, lambda: aou().most_common_synonym(coding_sets())),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_result(history, scale):
+    if not os.path.exists(history):
+        return None
+    previous = None
+    with open(history) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['scale'] == scale:
+                previous = result
+    return previous
+
+
+def regressions(result, previous, threshold=0.1):
+    if not previous:
+        return {}
+    slower = {}
+    for name, seconds in result['seconds'].items():
+        before = previous['seconds'].get(name)
+        if before and seconds > before * (1 + threshold):
+            slower[name] = {'before': before, 'after': seconds, 'commit': previous['commit']}
+    return slower
+
+
+def run(data, scale, repeat=3, selected=None):
+    results = {}
+    for name, (setup, fn) in benchmarks(data).items():
+        if selected and name not in selected:
+            continue
+        results[name] = time_it(fn, repeat, setup)
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': scale,
+        'seconds': results,
+        'files_per_second': discovery_rates(data, repeat),
+    }
+
+
+def main():
+    """Time the main entry points on synthetic data, append the result to the
+    history file and report anything slower than the last run at the same scale.
+    """
+    args = parse_arguments()
+    scale = {
+        'participants': args.participants,
+        'resources': args.resources,
+        'vocabulary_size': args.vocabulary_size,
+        'seed': args.seed,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        data = args.data
+        if not data:
+            data = tmp
+            synthetic_data.generate(data, **scale)
+        result = run(data, scale, args.repeat, args.benchmark)
+    result['regressions'] = regressions(
+        result, last_result(args.history, scale), args.threshold
+    )
+    if args.history:
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+    return result
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,304 @@
+import argparse
+import csv
+import datetime
+import glob
+import json
+import logging
+import os
+
+import fhir_analyze
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+
+FHIR_CODING_COLUMNS = [
+    'person_id',
+    'category',
+    'resourceType',
+    'system',
+    'code',
+    'display',
+    'concept_id',
+]
+
+FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+CHUNK_SIZE = 50000
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o',
+        '--out',
+        help='Directory to write the columnar files to',
+        default='export',
+    )
+    parser.add_argument(
+        '--fhir-path',
+        help='Directory containing subdirectories for each patient',
+        default=None,
+    )
+    parser.add_argument(
+        '--omop-path',
+        help='Directory containing omop csv files',
+        default=None,
+    )
+    parser.add_argument(
+        '--concept-path',
+        help='Directory containing the CONCEPT csv files, used to fill in concept_id',
+        default=None,
+    )
+    parser.add_argument(
+        '--format',
+        help='Output file format',
+        choices=sorted(FORMATS),
+        default='parquet',
+    )
+    parser.add_argument(
+        '--chunk-size',
+        help='Rows buffered per partition before they are written out',
+        default=CHUNK_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+
+    return parser.parse_args()
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('columnar export needs pyarrow: pip install pyarrow')
+
+
+def to_int(value):
+    # OMOP ids sometimes come through as floats, e.g. "123.0"
+    return int(value.split('.')[0]) if '.' in value else int(value)
+
+
+def to_date(value):
+    return datetime.date.fromisoformat(value[:10])
+
+
+def to_datetime(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def column_type(column):
+    """pyarrow type and string converter for a column, from its name: `*_id`
+    columns (person_id, concept_id, the OMOP keys) are int64, `*_date` date32
+    and `*_datetime` timestamps. Everything else stays a string.
+    """
+    if column.endswith('_id'):
+        return pa.int64(), to_int
+    if column.endswith('_datetime'):
+        return pa.timestamp('us'), to_datetime
+    if column.endswith('_date'):
+        return pa.date32(), to_date
+    return pa.string(), None
+
+
+def typed_schema(columns):
+    return pa.schema([(column, column_type(column)[0]) for column in columns])
+
+
+def open_writer(path, schema, format_='parquet'):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    if format_ == 'parquet':
+        return pa.parquet.ParquetWriter(path, schema)
+    return pa.ipc.new_file(path, schema)
+
+
+class PartitionedWriter:
+    """Buffers rows per partition value and writes them out in chunks of
+    `chunk_size` rows, one file per partition under `<directory>/<key>=<value>`.
+    Only one chunk per partition is held in memory at a time. The partition key
+    is encoded in the directory name rather than stored as a column.
+    """
+    def __init__(self, directory, columns, key, format_='parquet', chunk_size=CHUNK_SIZE):
+        require_pyarrow()
+        self.directory = directory
+        self.columns = columns
+        self.key = key
+        self.key_index = columns.index(key)
+        self.format = format_
+        self.chunk_size = chunk_size
+        self.stored = [i for i in range(len(columns)) if i != self.key_index]
+        self.schema = typed_schema([columns[i] for i in self.stored])
+        self.converters = [column_type(columns[i])[1] for i in self.stored]
+        # columns a value could not be converted for, warned about once
+        self.uncastable = set()
+        self.buffers = {}
+        self.writers = {}
+        self.rows = 0
+
+    def path_for(self, value):
+        return os.path.join(
+            self.directory,
+            '{}={}'.format(self.key, value),
+            'part-0' + FORMATS[self.format],
+        )
+
+    def write(self, row):
+        value = row[self.key_index]
+        buffer = self.buffers.setdefault(value, [])
+        buffer.append(row)
+        if len(buffer) >= self.chunk_size:
+            self.flush(value)
+
+    def convert(self, value, convert, column):
+        if convert is None or value is None:
+            return value
+        if value == '':
+            return None
+        try:
+            return convert(value)
+        except ValueError:
+            if column not in self.uncastable:
+                self.uncastable.add(column)
+                logging.warning('{} has values that are not a {}, e.g. {!r}; written as null'.format(
+                    column, self.schema.field(column).type, value
+                ))
+            return None
+
+    def flush(self, value):
+        buffer = self.buffers.get(value)
+        if not buffer:
+            return
+        if value not in self.writers:
+            self.writers[value] = open_writer(self.path_for(value), self.schema, self.format)
+        table = pa.Table.from_arrays(
+            [
+                pa.array([self.convert(row[i], convert, field.name) for row in buffer], field.type)
+                for i, convert, field in zip(self.stored, self.converters, self.schema)
+            ],
+            schema=self.schema,
+        )
+        self.writers[value].write_table(table)
+        self.rows += len(buffer)
+        self.buffers[value] = []
+
+    def close(self):
+        for value in list(self.buffers):
+            self.flush(value)
+        for writer in self.writers.values():
+            writer.close()
+        return self.rows
+
+
+def concept_id_resolver(path='.', vocabulary=None):
+    """Return a function mapping a FHIR (system, code) pair to its OMOP
+    concept_id using the CONCEPT tables in `path`. `vocabulary` converts a FHIR
+    system to a vocabulary_id, e.g. `fhir_analyze.convert_vocabulary`.
+    """
+    concept_ids = {}
+    for filename in ['CONCEPT.csv', 'CONCEPT_CPT4.csv', 'CONCEPT_AOUPPI.csv']:
+        with open(os.path.join(path, filename), encoding='utf8', newline='') as csv_file:
+            for row in csv.DictReader(csv_file, delimiter="\t"):
+                concept_ids[(row['vocabulary_id'], row['concept_code'])] = row['concept_id']
+
+    def resolve(system, code):
+        if vocabulary is not None:
+            system = vocabulary(system)
+        return concept_ids.get((system, code))
+    return resolve
+
+
+def export_fhir_codings(out, path=".\\fhir\\Participant", resolve_concept=None,
+                        format_='parquet', chunk_size=CHUNK_SIZE):
+    """Stream every participant's codings into `<out>/fhir_coding`, partitioned
+    by category. Only one participant's resources are in memory at a time.
+    """
+    writer = PartitionedWriter(
+        os.path.join(out, 'fhir_coding'),
+        FHIR_CODING_COLUMNS,
+        'category',
+        format_,
+        chunk_size,
+    )
+    for person_id, base_uri, person in fhir_analyze.iter_participants(path):
+        for row in fhir_analyze.coding_rows(person_id, person):
+            concept_id = None
+            if resolve_concept is not None:
+                concept_id = resolve_concept(row[3], row[4])
+            writer.write(row + (concept_id,))
+    rows = writer.close()
+    print("Exported {} s4s codings".format(rows))
+    return rows
+
+
+def export_omop_csv(out, filename, format_='parquet', chunk_size=CHUNK_SIZE):
+    """Stream one OMOP csv into `<out>/omop/table=<name>/`, `chunk_size` rows at
+    a time.
+    """
+    require_pyarrow()
+    table = os.path.splitext(os.path.basename(filename))[0]
+    with open(filename, encoding='utf8', newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader, None)
+        if not header:
+            return 0
+        writer = PartitionedWriter(
+            os.path.join(out, 'omop'),
+            ['table'] + header,
+            'table',
+            format_,
+            chunk_size,
+        )
+        for row in reader:
+            row = row + [None] * (len(header) - len(row))
+            writer.write([table] + row[:len(header)])
+    return writer.close()
+
+
+def export_omop(out, path=".\\omop\\20190326", extension='csv',
+                format_='parquet', chunk_size=CHUNK_SIZE):
+    total = 0
+    for filename in glob.glob(os.path.join(path, '*.{}'.format(extension))):
+        total += export_omop_csv(out, filename, format_, chunk_size)
+    print("Exported {} omop rows".format(total))
+    return total
+
+
+def main():
+    """Export whichever sources were given and return the row counts written."""
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    results = {}
+    if args.fhir_path:
+        resolve_concept = None
+        if args.concept_path:
+            resolve_concept = concept_id_resolver(
+                args.concept_path, fhir_analyze.convert_vocabulary
+            )
+        results['fhir_coding'] = export_fhir_codings(
+            args.out, args.fhir_path, resolve_concept, args.format, args.chunk_size
+        )
+        fhir_analyze.vocabulary_resolver.report()
+    if args.omop_path:
+        results['omop'] = export_omop(
+            args.out, args.omop_path, format_=args.format, chunk_size=args.chunk_size
+        )
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -1,12 +1,17 @@
 from __future__ import division
 
 import argparse
-from collections import Counter, defaultdict
-import glob
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+import hashlib
 import json
 import logging
 import os
 import re
+import sys
+
+import profiling
 
 
 FILE_TYPE_MAPPING = {
@@ -28,6 +33,195 @@ FILE_TYPE_MAPPING = {
 
 BASE_URI_TEMPLATE = r'(?P<base_uri>.*/){}(/[A-Za-z0-9\-\.]{{1,64}})?(\?.*)?'
 
+# compiled once per type instead of formatting the template for every query
+BASE_URI_PATTERNS = {
+    type_: re.compile(BASE_URI_TEMPLATE.format(resource_type))
+    for type_, resource_type in FILE_TYPE_MAPPING.items()
+}
+
+
+NO_DATA = 'Empty raw value'
+
+converter = {
+    NO_DATA: NO_DATA,
+    'http://loinc.org': 'LOINC',
+    'http://snomed.info/sct': 'SNOMED',
+    'http://hl7.org/fhir/sid/icd-9-cm/diagnosis': 'ICD9CM',
+    'http://www.ama-assn.org/go/cpt': 'CPT4',
+    'http://hl7.org/fhir/sid/icd-9-cm': 'ICD9CM',
+    'http://hl7.org/fhir/sid/icd-10-cm': 'ICD10CM',
+    'urn:oid:2.16.840.1.113883.6.90': 'ICD10CM',
+    'urn:oid:2.16.840.1.113883.6.14': 'HCPCS',
+    'http://www.nlm.nih.gov/research/umls/rxnorm': 'RxNorm',
+    'http://hl7.org/fhir/sid/ndc': 'NDC',
+    'http://hl7.org/fhir/ndfrt': 'None',
+    'http://fdasis.nlm.nih.gov': 'None',
+    'http://hl7.org/fhir/sid/cvx': 'CVX',
+    'http://hl7.org/fhir/observation-category': 'Observation Type',
+    'https://apis.followmyhealth.com/fhir/id/translation': 'None',
+    'http://argonautwiki.hl7.org/extension-codes': 'None',
+    'http://hl7.org/fhir/condition-category': 'None',
+    'http://argonaut.hl7.org': 'None',
+}
+
+# (prefix, vocabulary) rules for whole families of systems, longest prefix wins
+converter_prefixes = [
+    # Epic client OIDs, urn:oid:1.2.840.114350.1.13.<client>.2.7.2.<list>.
+    # I need to figure out what the suffix means.
+    ('urn:oid:1.2.840.114350.', 'None'),
+]
+
+
+class SystemResolver:
+    """Maps FHIR code systems to OMOP vocabulary ids using exact matches
+    first and then prefix rules. Exact matches are looked up every time, so
+    systems added to `exact` later (e.g. `converter[...] = ...` in the notebook)
+    take effect right away. Prefix decisions are memoized. Systems that match
+    no rule are returned unchanged and counted in `unknown`, so they can be
+    reported once with `report()` instead of on every lookup.
+    """
+    def __init__(self, exact, prefixes=()):
+        self.exact = exact
+        self.prefixes = sorted(prefixes, key=lambda rule: len(rule[0]), reverse=True)
+        self.memo = {}
+        self.unknown = Counter()
+
+    def resolve(self, system):
+        if system in self.exact:
+            return self.exact[system], True
+        if isinstance(system, str):
+            for prefix, vocabulary in self.prefixes:
+                if system.startswith(prefix):
+                    return vocabulary, True
+        return system, False
+
+    def __call__(self, system):
+        try:
+            return self.exact[system]
+        except KeyError:
+            pass
+        try:
+            vocabulary, known = self.memo[system]
+        except KeyError:
+            vocabulary, known = self.memo[system] = self.resolve(system)
+        if not known:
+            self.unknown[system] += 1
+        return vocabulary
+
+    def clear(self):
+        self.memo.clear()
+        self.unknown.clear()
+
+    def report(self):
+        # stderr, so it doesn't end up in the json the scripts print
+        if self.unknown:
+            print("found {} missing systems:".format(len(self.unknown)), file=sys.stderr)
+            for system, count in self.unknown.most_common():
+                print("  {} ({} codings)".format(system, count), file=sys.stderr)
+        return self.unknown
+
+
+vocabulary_resolver = SystemResolver(converter, converter_prefixes)
+
+
+def convert_vocabulary(system):
+    return vocabulary_resolver(system)
+
+
+def path_for_resource(resource):
+    resource_type = resource['resourceType']
+    code_paths = {
+        #'OperationOutcome': ['details', 'coding'],
+        'OperationOutcome': ['issue', 'details', 'coding'],
+        'MedicationOrder': ['medicationCodeableConcept', 'coding'], # no idea what I actually need here
+        'MedicationStatement': ['medicationCodeableConcept', 'coding'],
+        'AllergyIntolerance': ['substance', 'coding'],
+        'Observation': ['code', 'coding'], #code, coding
+        'Immunization': ['vaccineCode', 'coding'],
+        'Condition': ['code', 'coding'], #code, coding
+        'DocumentReference': ['class', 'coding'],
+        'Procedure': ['code', 'coding'],
+        'Patient': ['code', 'coding'],
+    }
+    return code_paths[resource_type]
+
+
+def fetch_at_path(resource, path):
+    if type(path) == type(''):
+        path = path.split('.')
+    def walk(data, k):
+        if isinstance(data, dict):
+            return data.get(k)
+        elif isinstance(data, list):
+            return [reduce(walk, [k], el) for el in data]
+        return None
+    return reduce(walk, path, resource)
+
+
+def codings_for_resource(resource):
+    """Yield the coding dicts found at the resource's code path. Resource types
+    without a known code path yield nothing. Some servers nest codings in an
+    extra list; the first coding of those is used.
+    """
+    try:
+        fetched = fetch_at_path(resource, path_for_resource(resource))
+    except KeyError:
+        return
+    for f in fetched or []:
+        if isinstance(f, list):
+            if not f:
+                continue
+            f = f[0]
+        if isinstance(f, dict):
+            yield f
+
+
+def coding_rows(person_id, person):
+    """Flatten a participant's resources (as returned by `data_in_directory`)
+    into (person_id, category, resourceType, system, code, display) tuples.
+    """
+    for category, entries in person.items():
+        for entry in entries:
+            resource_type = entry.get('resourceType')
+            for f in codings_for_resource(entry):
+                yield (
+                    person_id,
+                    category,
+                    resource_type,
+                    f.get('system'),
+                    f.get('code'),
+                    f.get('display'),
+                )
+
+
+def person_selected(person_id, person_ids=None):
+    """Whether `person_id` is selected by `person_ids`, which is None (select
+    everyone), a collection of ids or a `range` of numeric ids.
+    """
+    if person_ids is None:
+        return True
+    if isinstance(person_ids, range):
+        try:
+            return int(person_id) in person_ids
+        except ValueError:
+            return False
+    return person_id in person_ids
+
+
+def person_id_for_directory(directory):
+    """Participant id for a `<participant>/SyncForScience` directory, i.e. the
+    participant directory name without its leading character.
+    """
+    participant_dir = os.path.dirname(os.path.normpath(directory))
+    return os.path.basename(participant_dir)[1:]
+
+
+def load_json(path):
+    with profiling.stage('json_load'), open(path) as f:
+        profiling.count('files_read')
+        profiling.count('bytes_parsed', os.fstat(f.fileno()).st_size)
+        return json.load(f)
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -61,47 +255,61 @@ def parse_arguments():
         default='',
 
     )
+    parser.add_argument(
+        '--person',
+        help='Only analyse this participant id (can be repeated)',
+        action='append',
+        default=None,
+    )
+    parser.add_argument(
+        '--category',
+        help='Only read this resource type, e.g. PROBLEMS (can be repeated)',
+        action='append',
+        choices=sorted(FILE_TYPE_MAPPING),
+        default=None,
+    )
+    profiling.add_arguments(parser)
 
     return parser.parse_args()
 
 
-def find_resource_files(directory):
+def find_resource_files(directory, categories=None):
     """Yield tuples of resource type (e.g. `SMOKING_STATUS`), full path of the
     resource results file obtained from the log files in each subdirectory and
     corresponding base FHIR URI. Resource type is determined by characters from
-    the filename up to the first period.
+    the filename up to the first period. If `categories` is given, only files
+    of those `FILE_TYPE_MAPPING` types are yielded.
     """
-    for subdir in os.listdir(directory):
-        path = os.path.join(directory, subdir)
-        if not os.path.isdir(path):
-            continue
+    # scandir entries carry their file type, so this needs no stat per entry
+    with os.scandir(directory) as entries:
+        subdirs = [entry.path for entry in entries if entry.is_dir()]
+    for path in subdirs:
         try:
-            with open(os.path.join(path, 'log.json')) as f:
-                log_data = json.load(f)
+            log_data = load_json(os.path.join(path, 'log.json'))
             logging.debug('Parsed log file in {}'.format(path))
             for query in log_data['query']:
                 if query['status'] != 200:
                     continue
                 filename = query['response']
                 type_ = filename[:filename.index('.')]
+                if categories is not None and type_ not in categories:
+                    continue
 
-                m = re.match(
-                    BASE_URI_TEMPLATE.format(FILE_TYPE_MAPPING[type_]),
-                    query['request']
-                )
+                m = BASE_URI_PATTERNS[type_].match(query['request'])
                 base_uri = m.group('base_uri')
 
-                logging.debug('Found {} of type {}'.format(
-                    os.path.join(path, filename), type_
-                ))
-                yield type_, os.path.join(path, filename), base_uri
+                resource_path = os.path.join(path, filename)
+                # lazy arguments, this runs for every file in the cohort
+                logging.debug('Found %s of type %s', resource_path, type_)
+                yield type_, resource_path, base_uri
         except (IOError, ValueError, KeyError):
             # ignore if log file doesn't exist, doesn't parse as JSON or the
             # JSON doesn't have the keys we expect
             continue
 
 
-def process_directory(directory):
+@profiling.stage('process_directory')
+def process_directory(directory, categories=None):
     """Given a `SyncForScience` directory within a patient directory, collects
     total number of resources returned in each searchset by counting unique
     resource IDs for each JSON file present in the directory tree. Returns the
@@ -113,18 +321,17 @@ def process_directory(directory):
 
     uniques = defaultdict(set)
     base_uri = None
-    for type_, path, resource_base_uri in find_resource_files(directory):
+    for type_, path, resource_base_uri in find_resource_files(directory, categories):
         if not base_uri:
             base_uri = resource_base_uri
 #         if type_ == 'PATIENT_DEMOGRAPHICS':
 #             logging.debug('Skipping {}'.format(path))
 #             continue  # do nothing with patient demographics for now
         try:
-            with open(path) as f:
-                data = json.load(f)
-                logging.debug(
-                    'Parsed {} as JSON'.format(path)
-                )
+            data = load_json(path)
+            logging.debug(
+                'Parsed {} as JSON'.format(path)
+            )
         except ValueError:
             logging.debug(
                 '{} could not be parsed as JSON'.format(path)
@@ -142,23 +349,60 @@ def process_directory(directory):
 
     return base_uri, uniques
 
-def data_in_directory(directory):
+def unique_resource_ids(person):
+    """The mapping of resource type to unique resource IDs `process_directory`
+    returns, from the resources `data_in_directory` collected, so a directory
+    that is read anyway does not have to be read again.
+    """
+    uniques = defaultdict(set)
+    for type_, resources in person.items():
+        uniques[type_].update(
+            resource['id']
+            for resource in resources
+            # a bare PATIENT_DEMOGRAPHICS resource (kept with an empty 'entry')
+            # is not a searchset entry, process_directory does not count it
+            if 'entry' not in resource and 'id' in resource
+            and resource.get('resourceType') == FILE_TYPE_MAPPING[type_]
+        )
+    return uniques
+
+@profiling.stage('data_in_directory')
+def data_in_directory(directory, hash_content=False, categories=None):
     """Given a `SyncForScience` directory within a patient directory, collects
     the data entries by resourceType
     """
     logging.debug('Processing {}'.format(directory))
+    return data_in_files(find_resource_files(directory, categories), hash_content)
+
+
+def content_hash(resource):
+    return hashlib.sha1(
+        json.dumps(resource, sort_keys=True).encode('utf8')
+    ).hexdigest()
+
+
+def data_in_files(resource_files, hash_content=False):
+    """Collects the data entries by resourceType from (type, path, base_uri)
+    tuples as yielded by `find_resource_files`.
 
+    Resources returned more than once for the same type (e.g. by paginated or
+    overlapping queries) are kept once, keyed on the server's base URI,
+    resourceType and id, so equal ids from different servers stay apart. With
+    `hash_content`, a repeated resource whose content differs replaces the
+    earlier version and is counted as changed.
+    """
     person = {}
     base_uri = None
-    for type_, path, resource_base_uri in find_resource_files(directory):
+    # (base_uri, type, resourceType, id) -> (position in person[type], content hash)
+    seen = {}
+    for type_, path, resource_base_uri in resource_files:
         if not base_uri:
             base_uri = resource_base_uri
         try:
-            with open(path) as f:
-                data = json.load(f)
-                logging.debug(
-                    'Parsed {} as JSON'.format(path)
-                )
+            data = load_json(path)
+            logging.debug(
+                'Parsed {} as JSON'.format(path)
+            )
         except ValueError:
             logging.debug(
                 '{} could not be parsed as JSON'.format(path)
@@ -170,26 +414,147 @@ def data_in_directory(directory):
         if 'entry' not in data:
             if type_ == "PATIENT_DEMOGRAPHICS":
                 person[type_] = [data]
+                # the earlier resources of this type and their positions are gone
+                seen = {key: value for key, value in seen.items() if key[1] != type_}
 #             else:
 #                 print("empty bundle of ", type_)
             data['entry'] = list()  # no data
 
         for entry in data['entry']:
-            person[type_].append(entry['resource'])
+            resource = entry['resource']
+            resource_id = resource.get('id')
+            if resource_id is None:
+                person[type_].append(resource)
+                continue
+            key = (resource_base_uri, type_, resource.get('resourceType'), resource_id)
+            digest = content_hash(resource) if hash_content else None
+            if key not in seen:
+                seen[key] = (len(person[type_]), digest)
+                person[type_].append(resource)
+                continue
+            profiling.count('duplicate_resources')
+            position, previous_digest = seen[key]
+            if digest != previous_digest:
+                profiling.count('changed_resources')
+                person[type_][position] = resource
+                seen[key] = (position, digest)
+        profiling.count('resources_ingested', len(data['entry']))
 
     return base_uri, person
 
-def traverse_directory(path=".\\fhir\\Participant"):
+def participant_directories(path=".\\fhir\\Participant", person_ids=None):
+    """Yield (person_id, directory) for each `SyncForScience` directory whose
+    participant is selected by `person_ids`.
+    """
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return
+    with entries:
+        # like glob, skip hidden directories
+        participants = [
+            entry for entry in entries
+            if not entry.name.startswith('.') and entry.is_dir()
+        ]
+    for entry in participants:
+        directory = os.path.join(entry.path, 'SyncForScience')
+        person_id = person_id_for_directory(directory)
+        # skip unselected participants before touching their directory
+        if person_selected(person_id, person_ids) and os.path.isdir(directory):
+            yield person_id, directory
+
+
+def iter_participants(path=".\\fhir\\Participant", hash_content=False,
+                      person_ids=None, categories=None, workers=0):
+    """Yield (person_id, base_uri, resources) for each participant directory,
+    reading one participant at a time. `resources` is the mapping of resource
+    type to list of resources returned by `data_in_directory`. Participants not
+    in `person_ids` and files not in `categories` are never opened.
+
+    With `workers`, up to twice that many upcoming participants are read ahead
+    in a thread pool, so metadata and file reads on slow (e.g. network)
+    storage overlap. Participants are still yielded in order.
+    """
+    directories = participant_directories(path, person_ids)
+    if not workers:
+        for person_id, directory in directories:
+            base_uri, resources = data_in_directory(directory, hash_content, categories)
+            yield person_id, base_uri, resources
+        return
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for person_id, directory in directories:
+            pending.append((person_id, executor.submit(
+                data_in_directory, directory, hash_content, categories
+            )))
+            if len(pending) >= 2 * workers:
+                person_id, future = pending.popleft()
+                yield (person_id,) + future.result()
+        while pending:
+            person_id, future = pending.popleft()
+            yield (person_id,) + future.result()
+
+
+def iter_people(fhir_people):
+    """Yield (person_id, resources) pairs from either a `traverse_directory`
+    dict or an `iter_participants` iterator, so reports can take both.
+    """
+    if isinstance(fhir_people, dict):
+        for person_id, resources in fhir_people.items():
+            yield person_id, resources
+    else:
+        for person_id, base_uri, resources in fhir_people:
+            yield person_id, resources
+
+
+@profiling.stage('traverse_directory')
+def traverse_directory(path=".\\fhir\\Participant", person_ids=None, categories=None,
+                       workers=0):
     s4s_people = {}
-    search_path = os.path.join(path, '*', 'SyncForScience')
-    for directory in glob.glob(search_path):
-        base_uri, dir_counts = data_in_directory(directory)
-        person_id = directory.split('\\')[-2][1:]
-        s4s_people[person_id] = dir_counts
+    for person_id, base_uri, resources in iter_participants(
+        path, person_ids=person_ids, categories=categories, workers=workers
+    ):
+        s4s_people[person_id] = resources
     print("got {} s4s participants".format(len(s4s_people.keys())))
     return s4s_people
 
 
+def count_summary(counts, bin_size):
+    """Mean, median, min, max and histogram of the per patient resource
+    counts `counts` (a list, sorted in place).
+    """
+    counts.sort()  # for median
+    n = len(counts)
+    summary = {
+        'mean': sum(counts) / n,
+        'median': counts[n // 2],  # not a true median, oops
+        'min': counts[0],
+        'max': counts[-1],
+        'histogram': list()
+    }
+
+    # generate histogram data
+    b = 0
+    while True:
+        # number of counts in the bin
+        in_bin = sum(
+            b * bin_size <= x < (b + 1) * bin_size
+            for x in counts
+        )
+        if not in_bin:
+            b += 1
+            continue  # to save space, don't print empty bins
+        summary['histogram'].append({
+            'bin_start': b * bin_size,
+            'bin_end': (b + 1) * bin_size - 1,  # inclusive
+            'count': in_bin
+        })
+        if (b + 1) * bin_size > counts[-1]:
+            break
+        b += 1
+    return summary
+
+
 def main():
     """Find patient S4S directories and compute statistics on the number of
     resources found for each resource type present stratified by base FHIR URI.
@@ -197,55 +562,28 @@ def main():
     """
     args = parse_arguments()
     logging.basicConfig(level=args.log_level)
+    profiling.configure(args)
 
     # mapping of base URI to another mapping of resource type to list of
     # resource counts for each patient
     total_counts = defaultdict(lambda: defaultdict(list))
 
-    search_path = os.path.join(args.path, '*', 'SyncForScience')
-    for directory in glob.glob(search_path):
-        base_uri, dir_counts = process_directory(directory)
-        for type_, count in dir_counts.items():
-            total_counts[base_uri][type_].append(count)
+    for person_id, directory in participant_directories(args.path, args.person):
+        base_uri, dir_counts = process_directory(directory, args.category)
+        for type_, uniques in dir_counts.items():
+            total_counts[base_uri][type_].append(len(uniques))
 
     # TODO: pad each count list with 0s if necessary
 
     # output data structure
     results = dict()
     for base_uri, uri_counts in total_counts.items():
-        uri_results = dict()
-        for type_, counts in uri_counts.items():
-            counts.sort()  # for median
-            n = len(counts)
-            summary = {
-                'mean': sum(counts) / n,
-                'median': counts[n // 2],  # not a true median, oops
-                'min': counts[0],
-                'max': counts[-1],
-                'histogram': list()
-            }
-
-            # generate histogram data
-            b = 0
-            while True:
-                # number of counts in the bin
-                in_bin = sum(
-                    b * args.bin_size <= x < (b + 1) * args.bin_size
-                    for x in counts
-                )
-                if not in_bin:
-                    b += 1
-                    continue  # to save space, don't print empty bins
-                summary['histogram'].append({
-                    'bin_start': b * args.bin_size,
-                    'bin_end': (b + 1) * args.bin_size - 1,  # inclusive
-                    'count': in_bin
-                })
-                if (b + 1) * args.bin_size > counts[-1]:
-                    break
-                b += 1
-            uri_results[type_] = summary
-        results[base_uri] = uri_results
+        results[base_uri] = {
+            type_: count_summary(counts, args.bin_size)
+            for type_, counts in uri_counts.items()
+        }
+    profiling.finish(args)
+    vocabulary_resolver.report()
     return results
 
 
@@ -5,6 +5,9 @@ import json
 import logging
 import argparse
 
+import profiling
+from fhir_analyze import person_selected
+
 code_column = {
     'condition.csv': 'condition_concept_id',
     'observation_1.csv': 'observation_concept_id',
@@ -16,6 +19,16 @@ code_column = {
     'measurement.csv': 'measurement_concept_id',
 }
 
+# (concept_id, source_concept_id) columns of the tables with codes
+CODE_COLUMNS = {
+    'condition.csv': ('condition_concept_id', 'condition_source_concept_id'),
+    'observation.csv': ('observation_concept_id', 'observation_source_concept_id'),
+    'procedure.csv': ('procedure_concept_id', 'procedure_source_concept_id'),
+    'drug_summary.csv': ('drug_concept_id', 'drug_source_concept_id'),
+    'drug.csv': ('drug_concept_id', 'drug_source_concept_id'),
+    'measurement.csv': ('measurement_concept_id', 'measurement_source_concept_id'),
+}
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -33,14 +46,62 @@ def parse_arguments():
         const=logging.DEBUG,
         default=logging.WARNING,
     )
+    parser.add_argument(
+        '--table',
+        help='Only read this csv, e.g. condition.csv (can be repeated)',
+        action='append',
+        default=None,
+    )
+    parser.add_argument(
+        '--column',
+        help='Only keep this column, person_id is always kept (can be repeated)',
+        action='append',
+        default=None,
+    )
+    parser.add_argument(
+        '--person',
+        help='Only keep rows of this person_id (can be repeated)',
+        action='append',
+        default=None,
+    )
+    profiling.add_arguments(parser)
 
     return parser.parse_args()
 
-def csv_to_dicts(filename):
-    with open(filename, encoding="utf8") as csv_file:
-        items = (filename, list(csv.DictReader(csv_file)))
+def csv_to_dicts(filename, columns=None, person_ids=None):
+    """Read a csv into (filename, list of row dicts). If `columns` is given only
+    those columns (plus person_id) are kept, and if `person_ids` is given only
+    rows of those participants, so unselected data is never held in memory.
+    """
+    with profiling.stage('csv_to_dicts'), open(filename, encoding="utf8") as csv_file:
+        profiling.count('files_read')
+        profiling.count('bytes_parsed', os.fstat(csv_file.fileno()).st_size)
+        if columns is None and person_ids is None:
+            items = (filename, list(csv.DictReader(csv_file)))
+        else:
+            items = (filename, list(selected_rows(csv_file, columns, person_ids)))
+    profiling.count('rows_ingested', len(items[1]))
     return items
 
+def selected_rows(csv_file, columns=None, person_ids=None):
+    reader = csv.reader(csv_file)
+    header = next(reader, [])
+    if columns is None:
+        keep = list(enumerate(header))
+    else:
+        keep = [
+            (i, column) for i, column in enumerate(header)
+            if column in columns or column == 'person_id'
+        ]
+    person_column = header.index('person_id') if 'person_id' in header else None
+    for row in reader:
+        if person_ids is not None:
+            if person_column is None or person_column >= len(row):
+                continue
+            if not person_selected(row[person_column], person_ids):
+                continue
+        yield {column: row[i] if i < len(row) else None for i, column in keep}
+
 def ids_for_column(data, column_name):
     return list(set(item[column_name] for item in data))
 
@@ -52,25 +113,34 @@ def id_sets_for_interesting_columns(csvs):
         })
     return ids
 
+def csv_filenames(path, extension='csv'):
+    # joined rather than chdir'ed into, the working directory is shared by all threads
+    return [
+        os.path.basename(filename)
+        for filename in glob.glob(os.path.join(glob.escape(path), '*.{}'.format(extension)))
+    ]
+
+@profiling.stage('data_dump')
 def data_dump(path=".\\omop\\20190326", extension='csv'):
-    cwd = os.getcwd()
-    os.chdir(path)
-    csvs = [i for i in glob.glob('*.{}'.format(extension))]
+    csvs = csv_filenames(path, extension)
     print(csvs)
     data = []
     for file in csvs:
-        dicts = csv_to_dicts(file)
+        dicts = file, csv_to_dicts(os.path.join(path, file))[1]
         data.append(dicts)
-    os.chdir(cwd)
     return data
 
-def parse_omop(path=".\\omop\\20190326", extension='csv'):
-    cwd = os.getcwd()
-    os.chdir(path)
-    csvs = [i for i in glob.glob('*.{}'.format(extension))]
+@profiling.stage('parse_omop')
+def parse_omop(path=".\\omop\\20190326", extension='csv', tables=None,
+               columns=None, person_ids=None):
+    """Group OMOP rows by person_id and csv filename. `tables` (csv filenames,
+    e.g. the keys of `CODE_COLUMNS`), `columns` and `person_ids` restrict what
+    is read; unselected csvs are never opened.
+    """
+    csvs = [i for i in csv_filenames(path, extension) if tables is None or i in tables]
     # print(csvs)
     patients = {}
-    for filename, table in [csv_to_dicts(csv) for csv in csvs]:
+    for filename, table in ((csv, csv_to_dicts(os.path.join(path, csv), columns, person_ids)[1]) for csv in csvs):
         for interaction in table:
             if interaction.get('person_id', False) in patients:
                 if filename in patients[interaction['person_id']]:
@@ -83,7 +153,6 @@ def parse_omop(path=".\\omop\\20190326", extension='csv'):
                 else:
                     print("found line without patient")
     print("Got {} omop participants".format(len(patients.keys())))
-    os.chdir(cwd)
     return patients, csvs
 
 def main():
@@ -91,8 +160,11 @@ def main():
     """
     args = parse_arguments()
     logging.basicConfig(level=args.log_level)
+    profiling.configure(args)
     extension = 'csv'
-    return parse_omop(args.path, extension)
+    omop = parse_omop(args.path, extension, args.table, args.column, args.person)
+    profiling.finish(args)
+    return omop
 
 
 if __name__ == '__main__':
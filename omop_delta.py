@@ -0,0 +1,230 @@
+import argparse
+from collections import Counter, defaultdict
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import omop_analyze
+import profiling
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'old',
+        help='Directory containing the older omop csv files, e.g. omop/20190326',
+    )
+    parser.add_argument(
+        'new',
+        help='Directory containing the newer omop csv files, e.g. omop/20190823',
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+
+    return parser.parse_args()
+
+
+def row_hash(row):
+    return hashlib.blake2b('\x1f'.join(row).encode('utf8'), digest_size=8).digest()
+
+
+def record_id_column(header):
+    # OMOP tables lead with their own primary key, e.g. condition_occurrence_id
+    if header and header[0].endswith('_id') and header[0] != 'person_id':
+        return 0
+    return None
+
+
+def iter_drop(path, extension='csv'):
+    """Yield (table, header, rows) for every csv in an OMOP drop, streaming
+    the rows as lists.
+    """
+    for filename in sorted(glob.glob(os.path.join(path, '*.{}'.format(extension)))):
+        with open(filename, encoding='utf8', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, None)
+            if not header or 'person_id' not in header:
+                continue
+            yield os.path.basename(filename), header, reader
+
+
+@profiling.stage('drop_digest')
+def drop_digest(path, extension='csv'):
+    """Compact summary of an OMOP drop: for each table, record id -> (person_id,
+    row hash), or person_id -> Counter of row hashes for tables without a
+    record id column, plus row counts per (table, person_id). Compute it once
+    per drop and compare it against later drops with `diff_drops`.
+    """
+    digest = {}
+    for table, header, rows in iter_drop(path, extension):
+        person_column = header.index('person_id')
+        id_column = record_id_column(header)
+        records = {}
+        counts = Counter()
+        for row in rows:
+            if len(row) <= person_column:
+                continue
+            person_id = row[person_column]
+            counts[person_id] += 1
+            if id_column is None:
+                records.setdefault(person_id, Counter())[row_hash(row)] += 1
+            else:
+                records[row[id_column]] = (person_id, row_hash(row))
+        digest[table] = {'keyed': id_column is not None, 'records': records, 'counts': counts}
+        profiling.count('omop_rows_digested', sum(counts.values()))
+    return digest
+
+
+def person_change(people, table, person_id):
+    return people[person_id].setdefault(table, Counter())
+
+
+@profiling.stage('diff_drops')
+def diff_drops(old, new_path, extension='csv'):
+    """Compare the digest of an older drop (`drop_digest`) with the drop in
+    `new_path`, reading the new drop once. Returns added/removed/changed record
+    counts per table, per person changes (including old and new row counts) and
+    the set of person ids with any change.
+    """
+    tables = {}
+    people = defaultdict(dict)
+    seen_tables = set()
+    for table, header, rows in iter_drop(new_path, extension):
+        seen_tables.add(table)
+        person_column = header.index('person_id')
+        id_column = record_id_column(header)
+        previous = old.get(table, {'keyed': id_column is not None, 'records': {}, 'counts': Counter()})
+        keyed = previous['keyed'] and id_column is not None
+        # copies, so the old digest can be diffed against several drops
+        remaining = dict(previous['records']) if keyed else {
+            person_id: Counter(hashes) for person_id, hashes in previous['records'].items()
+        }
+        summary = tables[table] = Counter()
+        counts = Counter()
+        for row in rows:
+            if len(row) <= person_column:
+                continue
+            person_id = row[person_column]
+            counts[person_id] += 1
+            digest = row_hash(row)
+            if keyed:
+                before = remaining.pop(row[id_column], None)
+                if before is None:
+                    change = 'added'
+                elif before != (person_id, digest):
+                    change = 'changed'
+                    if before[0] != person_id:
+                        # record moved between people, a change for both
+                        person_change(people, table, before[0])['changed'] += 1
+                else:
+                    continue
+            else:
+                hashes = remaining.get(person_id)
+                if hashes and hashes[digest]:
+                    hashes[digest] -= 1
+                    continue
+                change = 'added'
+            summary[change] += 1
+            person_change(people, table, person_id)[change] += 1
+        # whatever is left of the old drop was removed
+        if keyed:
+            for person_id, digest in remaining.values():
+                summary['removed'] += 1
+                person_change(people, table, person_id)['removed'] += 1
+        else:
+            for person_id, hashes in remaining.items():
+                removed = sum(n for n in hashes.values() if n > 0)
+                if removed:
+                    summary['removed'] += removed
+                    person_change(people, table, person_id)['removed'] += removed
+        for person_id in set(counts) | set(previous['counts']):
+            if counts[person_id] != previous['counts'][person_id]:
+                change = person_change(people, table, person_id)
+                change['old_count'] = previous['counts'][person_id]
+                change['new_count'] = counts[person_id]
+    for table in set(old) - seen_tables:
+        # table dropped entirely from the new drop
+        tables[table] = Counter(removed=sum(old[table]['counts'].values()))
+        for person_id, count in old[table]['counts'].items():
+            change = person_change(people, table, person_id)
+            change.update({'removed': count, 'old_count': count, 'new_count': 0})
+    return {
+        'tables': {table: dict(summary) for table, summary in tables.items()},
+        'people': {person_id: {t: dict(c) for t, c in changes.items()} for person_id, changes in people.items()},
+        'changed_people': set(people),
+    }
+
+
+def update_omop_people(omop_people, delta, new_path, extension='csv'):
+    """Bring a `parse_omop` result for the old drop up to date with the new
+    drop by re-reading only the participants `diff_drops` found changed.
+    """
+    changed = delta['changed_people']
+    if not changed:
+        return omop_people
+    reparsed, csvs = omop_analyze.parse_omop(new_path, extension, person_ids=changed)
+    updated = {person_id: tables for person_id, tables in omop_people.items() if person_id not in changed}
+    updated.update(reparsed)
+    return updated
+
+
+def update_omop_pair_counts(aou_analysis, pair_counts, omop_people, updated_people, changed):
+    """Bring `aou_analysis.omop_concept_pair_counts` of the old drop up to date
+    by subtracting the `changed` people's old rows and adding their new ones.
+    `omop_people` and `updated_people` are the old and new `parse_omop` results,
+    e.g. from `update_omop_people`.
+    """
+    def coded(people):
+        # only tables omop_concept_pair_counts knows the code columns of
+        return {
+            person_id: {table: rows for table, rows in people[person_id].items() if table in aou_analysis.CODE_COLUMNS}
+            for person_id in changed if person_id in people
+        }
+    updated = {table: Counter(pairs) for table, pairs in pair_counts.items()}
+    for table, pairs in aou_analysis.omop_concept_pair_counts(coded(updated_people)).items():
+        updated.setdefault(table, Counter()).update(pairs)
+    for table, pairs in aou_analysis.omop_concept_pair_counts(coded(omop_people)).items():
+        updated[table].subtract(pairs)
+    # drop pairs (and tables) no row uses any more
+    updated = {table: +pairs for table, pairs in updated.items()}
+    return {table: pairs for table, pairs in updated.items() if pairs}
+
+
+def update_omop_reports(aou_analysis, pair_counts, omop_people, updated_people, changed):
+    """The OMOP system and coding reports for the new drop, from the old
+    drop's pair counts. Only the changed people's rows are counted, and only
+    concept pairs not seen before are resolved, since concept lookups are
+    memoized. Returns (pair_counts, omop_system_counts, omop_coding_counts).
+    """
+    pair_counts = update_omop_pair_counts(aou_analysis, pair_counts, omop_people, updated_people, changed)
+    return (
+        pair_counts,
+        aou_analysis.omop_system_counts_for_pairs(pair_counts),
+        aou_analysis.omop_coding_counts_for_pairs(pair_counts),
+    )
+
+
+def main():
+    """Print the differences between two OMOP drops."""
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    delta = diff_drops(drop_digest(args.old), args.new)
+    return {
+        'tables': delta['tables'],
+        'changed_people': len(delta['changed_people']),
+        'people': delta['people'],
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,201 @@
+import argparse
+import csv
+import glob
+import io
+import json
+import logging
+import os
+
+import fhir_analyze
+import profiling
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o',
+        '--out',
+        help='File to write the participant index to',
+        default='participant_index.json',
+    )
+    parser.add_argument(
+        '-f',
+        '--fhir-path',
+        help='Directory containing subdirectories for each patient',
+        default=None,
+    )
+    parser.add_argument(
+        '--omop-path',
+        help='Directory containing omop csv files',
+        default=None,
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+
+    return parser.parse_args()
+
+
+def csv_records(f):
+    """Yield (offset, length, line) for each csv record in binary file `f`,
+    keeping quoted fields that span several lines in one record.
+    """
+    offset = f.tell()
+    record = b''
+    for line in f:
+        record += line
+        if record.count(b'"') % 2:
+            continue  # inside a quoted field, keep reading
+        yield offset, len(record), record
+        offset += len(record)
+        record = b''
+    if record:
+        yield offset, len(record), record
+
+
+def index_omop_csv(filename):
+    """Map person_id to the byte spans of its rows in `filename`. Consecutive
+    rows of the same person are merged into a single [offset, length, rows] span.
+    """
+    stat = os.stat(filename)
+    with open(filename, 'rb') as f:
+        records = csv_records(f)
+        try:
+            header_offset, header_length, header_line = next(records)
+        except StopIteration:
+            return None
+        header = next(csv.reader([header_line.decode('utf8').lstrip('\ufeff')]))
+        if 'person_id' not in header:
+            return None
+        person_column = header.index('person_id')
+        people = {}
+        last_person = None
+        for offset, length, record in records:
+            row = next(csv.reader(io.StringIO(record.decode('utf8'))), None)
+            if not row or len(row) <= person_column:
+                continue
+            person_id = row[person_column]
+            spans = people.setdefault(person_id, [])
+            if person_id == last_person and spans[-1][0] + spans[-1][1] == offset:
+                spans[-1][1] += length
+                spans[-1][2] += 1
+            else:
+                spans.append([offset, length, 1])
+            last_person = person_id
+    profiling.count('omop_rows_indexed', sum(
+        span[2] for spans in people.values() for span in spans
+    ))
+    # offsets are only valid for this version of the file
+    return {'header': header, 'people': people, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ParticipantIndex:
+    """person_id -> S4S resource files and OMOP row spans, built once with
+    `build` and then used to load a single participant's data on demand.
+    """
+    def __init__(self, fhir=None, omop=None):
+        # person_id -> list of (type, path, base_uri) from find_resource_files
+        self.fhir_files = fhir or {}
+        # csv path -> {'header': [...], 'people': {person_id: [[offset, length, rows]]},
+        #              'size': ..., 'mtime_ns': ...}
+        self.omop_tables = omop or {}
+
+    @classmethod
+    @profiling.stage('build_participant_index')
+    def build(cls, fhir_path=None, omop_path=None, extension='csv'):
+        index = cls()
+        if fhir_path:
+            search_path = os.path.join(fhir_path, '*', 'SyncForScience')
+            for directory in glob.glob(search_path):
+                # absolute, so the index can be loaded from any directory
+                directory = os.path.abspath(directory)
+                person_id = fhir_analyze.person_id_for_directory(directory)
+                index.fhir_files[person_id] = [
+                    list(resource_file)
+                    for resource_file in fhir_analyze.find_resource_files(directory)
+                ]
+        if omop_path:
+            for filename in glob.glob(os.path.join(omop_path, '*.{}'.format(extension))):
+                table = index_omop_csv(filename)
+                if table:
+                    index.omop_tables[os.path.abspath(filename)] = table
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved index. Raises ValueError if an indexed OMOP csv changed
+        since the index was built, as its row offsets would be wrong.
+        """
+        with open(filename) as f:
+            data = json.load(f)
+        for path, table in data['omop'].items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                raise ValueError('{} is stale: {} no longer exists'.format(filename, path))
+            if (stat.st_size, stat.st_mtime_ns) != (table.get('size'), table.get('mtime_ns')):
+                raise ValueError('{} is stale: {} changed since it was indexed, rebuild it'.format(filename, path))
+        return cls(data['fhir'], data['omop'])
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'fhir': self.fhir_files, 'omop': self.omop_tables}, f)
+
+    def person_ids(self):
+        people = set(self.fhir_files)
+        for table in self.omop_tables.values():
+            people.update(table['people'])
+        return sorted(people)
+
+    def fhir(self, person_id):
+        """The participant's resources by type, as `data_in_directory` returns them.
+        Raises ValueError if one of the participant's indexed files is gone.
+        """
+        resource_files = [tuple(resource_file) for resource_file in self.fhir_files.get(person_id, [])]
+        # checked here rather than in load, which would stat every file of the cohort
+        for type_, path, base_uri in resource_files:
+            if not os.path.exists(path):
+                raise ValueError('participant index is stale: {} no longer exists, rebuild it'.format(path))
+        base_uri, resources = fhir_analyze.data_in_files(resource_files)
+        return resources
+
+    def omop(self, person_id):
+        """The participant's OMOP rows by csv filename, like one entry of the
+        `parse_omop` result.
+        """
+        tables = {}
+        for path, table in self.omop_tables.items():
+            spans = table['people'].get(person_id)
+            if not spans:
+                continue
+            rows = []
+            with open(path, 'rb') as f:
+                for offset, length, count in spans:
+                    f.seek(offset)
+                    text = f.read(length).decode('utf8')
+                    rows.extend(csv.DictReader(io.StringIO(text), fieldnames=table['header']))
+            tables[os.path.basename(path)] = rows
+        return tables
+
+
+def main():
+    """Build the participant index for the given sources and save it."""
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    index = ParticipantIndex.build(args.fhir_path, args.omop_path)
+    index.save(args.out)
+    return {
+        'fhir_participants': len(index.fhir_files),
+        'omop_tables': len(index.omop_tables),
+        'participants': len(index.person_ids()),
+    }
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,308 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+
+import fhir_analyze
+import omop_analyze
+import profiling
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-f',
+        '--fhir-path',
+        help='Directory containing subdirectories for each patient',
+        default='.\\fhir\\Participant',
+    )
+    parser.add_argument(
+        '-o',
+        '--omop-path',
+        help='Directory containing omop csv files',
+        default='.\\omop\\20190326',
+    )
+    parser.add_argument(
+        '-c',
+        '--concept-path',
+        help='Directory containing VOCABULARY.csv and the CONCEPT csv files',
+        default='.',
+    )
+    parser.add_argument(
+        '--cache',
+        help='Directory stage outputs are cached in',
+        default='.pipeline_cache',
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of stages run in parallel',
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        '--force',
+        help='Recompute this stage even if its inputs did not change (can be repeated)',
+        action='append',
+        default=[],
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+
+    return parser.parse_args()
+
+
+def path_fingerprint(path, digest):
+    """Feed the name, size and modification time of every file under `path`
+    into `digest`. Contents are not read, so fingerprinting a cohort is cheap.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        digest.update('{}|{}|{}\n'.format(path, stat.st_size, stat.st_mtime_ns).encode('utf8'))
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            stat = os.stat(filename)
+            digest.update('{}|{}|{}\n'.format(
+                os.path.relpath(filename, path), stat.st_size, stat.st_mtime_ns
+            ).encode('utf8'))
+    digest.update('{}\n'.format(os.path.abspath(path)).encode('utf8'))
+
+
+def code_fingerprint(filename, digest):
+    with open(filename, 'rb') as f:
+        digest.update(f.read())
+
+
+class Stage:
+    """One step of the pipeline. `fn` is called with the outputs of the
+    `inputs` stages (in order) followed by `params`. Its output is cached on
+    disk, keyed by a fingerprint of `files`, `params`, the code of `fn`'s module
+    and of `modules` (source files it depends on) and the fingerprints of its
+    inputs. Stages sharing a `lock` name never run at the same time.
+    """
+    def __init__(self, name, fn, inputs=(), files=(), params=None, modules=(), lock=None):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.files = list(files)
+        self.params = params or {}
+        self.modules = list(modules)
+        self.lock = lock
+
+    def fingerprint(self, input_fingerprints):
+        digest = hashlib.sha1()
+        digest.update(self.name.encode('utf8'))
+        # the whole module the stage function lives in, so changes to helpers count
+        for filename in [inspect.getsourcefile(self.fn)] + self.modules:
+            code_fingerprint(filename, digest)
+        digest.update(json.dumps(self.params, sort_keys=True, default=repr).encode('utf8'))
+        for path in self.files:
+            path_fingerprint(path, digest)
+        for fingerprint in input_fingerprints:
+            digest.update(fingerprint.encode('utf8'))
+        return digest.hexdigest()
+
+
+class Pipeline:
+    def __init__(self, stages, cache='.pipeline_cache'):
+        self.stages = {stage.name: stage for stage in stages}
+        # absolute, in case anything changes the working directory while stages run
+        self.cache = os.path.abspath(cache)
+        self.locks = {}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError('{} depends on unknown stage {}'.format(stage.name, name))
+            if stage.lock:
+                self.locks.setdefault(stage.lock, threading.Lock())
+
+    def order(self, targets=None):
+        """Stages needed for `targets` (default: all), dependencies first."""
+        ordered = []
+        visiting = set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError('dependency cycle through {}'.format(name))
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in targets or self.stages:
+            visit(name)
+        return ordered
+
+    def cache_path(self, name, fingerprint):
+        return os.path.join(self.cache, '{}-{}.pickle'.format(name, fingerprint))
+
+    def run(self, targets=None, workers=4, force=()):
+        """Run the stages needed for `targets`, loading unchanged stages from
+        the cache and computing independent stages in parallel. Returns
+        (outputs, status) where status records for every stage whether it was
+        'cached' or 'ran' and how long that took.
+        """
+        os.makedirs(self.cache, exist_ok=True)
+        order = self.order(targets)
+        fingerprints = {}
+        for name in order:
+            stage = self.stages[name]
+            fingerprints[name] = stage.fingerprint([fingerprints[i] for i in stage.inputs])
+
+        outputs = {}
+        status = {}
+        done = set()
+        pending = {}
+
+        def execute(name):
+            stage = self.stages[name]
+            start = time.perf_counter()
+            path = self.cache_path(name, fingerprints[name])
+            if name not in force and os.path.exists(path):
+                with open(path, 'rb') as f:
+                    output = pickle.load(f)
+                return output, 'cached', time.perf_counter() - start
+            args = [outputs[i] for i in stage.inputs]
+            lock = self.locks.get(stage.lock)
+            with profiling.stage('pipeline.' + name):
+                if lock:
+                    with lock:
+                        output = stage.fn(*args, **stage.params)
+                else:
+                    output = stage.fn(*args, **stage.params)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            return output, 'ran', time.perf_counter() - start
+
+        with ThreadPoolExecutor(max(1, workers)) as executor:
+            while len(done) < len(order):
+                for name in order:
+                    if name in done or name in pending.values():
+                        continue
+                    if all(i in done for i in self.stages[name].inputs):
+                        pending[executor.submit(execute, name)] = name
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = pending.pop(future)
+                    output, state, seconds = future.result()
+                    outputs[name] = output
+                    status[name] = {
+                        'status': state,
+                        'seconds': seconds,
+                        'fingerprint': fingerprints[name],
+                    }
+                    done.add(name)
+                    logging.debug('{} {} in {:.2f}s'.format(name, state, seconds))
+        return outputs, status
+
+
+def load_aou_analysis(concept_path='.'):
+    """Import `aou_analysis`, which loads the concept tables on import, with
+    the concept tables from `concept_path`.
+    """
+    previous = os.environ.get('AOU_CONCEPT_PATH')
+    os.environ['AOU_CONCEPT_PATH'] = os.path.abspath(concept_path)
+    try:
+        if 'aou_analysis' in sys.modules:
+            return importlib.reload(sys.modules['aou_analysis'])
+        return importlib.import_module('aou_analysis')
+    finally:
+        if previous is None:
+            del os.environ['AOU_CONCEPT_PATH']
+        else:
+            os.environ['AOU_CONCEPT_PATH'] = previous
+
+
+def concept_files(concept_path):
+    return [
+        os.path.join(concept_path, filename)
+        for filename in ['VOCABULARY.csv', 'CONCEPT.csv', 'CONCEPT_CPT4.csv', 'CONCEPT_AOUPPI.csv']
+    ]
+
+
+def default_pipeline(fhir_path, omop_path, concept_path='.', cache='.pipeline_cache'):
+    """The notebook's chain as stages: S4S traversal and OMOP parsing, then the
+    coding, synonym and comparison reports from `aou_analysis`. The concept
+    tables are loaded once, by the first report that has to run.
+    """
+    # stages run in threads, keep them independent of the working directory
+    fhir_path, omop_path, concept_path = map(os.path.abspath, [fhir_path, omop_path, concept_path])
+    aou = {}
+
+    def analysis():
+        # only import (and load the concept tables) when a report has to run
+        if 'module' not in aou:
+            aou['module'] = load_aou_analysis(concept_path)
+        return aou['module']
+
+    def coding_counts(s4s_people):
+        concept_table = analysis().concept_table
+        if 'concept_code' not in concept_table.columns:
+            # coding_counts indexes the concept table in place, undo a previous run
+            concept_table.reset_index(inplace=True)
+        return analysis().coding_counts(s4s_people)
+
+    def omop_people(parsed):
+        return parsed[0]
+
+    def synonyms(counts):
+        return counts['synonyms']
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = dict(
+        files=concept_files(concept_path),
+        modules=[os.path.join(here, name) for name in ['aou_analysis.py', 'fhir_analyze.py']],
+        # the reports share aou_analysis' concept table, which coding_counts re-indexes
+        lock='aou_analysis',
+    )
+    return Pipeline([
+        Stage('s4s_people', fhir_analyze.traverse_directory, files=[fhir_path], params={'path': fhir_path}),
+        Stage('omop_parse', omop_analyze.parse_omop, files=[omop_path], params={'path': omop_path}),
+        Stage('omop_people', omop_people, inputs=['omop_parse']),
+        Stage('code_system_counts', lambda people: analysis().code_system_counts(people),
+              inputs=['s4s_people'], **report),
+        Stage('coding_counts', coding_counts, inputs=['s4s_people'], **report),
+        Stage('synonyms', synonyms, inputs=['coding_counts']),
+        Stage('omop_system_counts', lambda people: analysis().omop_system_counts(people),
+              inputs=['omop_people'], **report),
+        Stage('omop_coding_counts', lambda people: analysis().omop_coding_counts(people),
+              inputs=['omop_people'], **report),
+        Stage('compare_per_patient', lambda fhir, omop: analysis().compare_per_patient(fhir, omop),
+              inputs=['s4s_people', 'omop_people'], **report),
+    ], cache)
+
+
+def main():
+    """Run the default pipeline, recomputing only stages whose inputs changed."""
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    pipeline = default_pipeline(args.fhir_path, args.omop_path, args.concept_path, args.cache)
+    outputs, status = pipeline.run(workers=args.workers, force=args.force)
+    fhir_analyze.vocabulary_resolver.report()
+    return status
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,149 @@
+from collections import Counter, defaultdict
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+# per-run state, cleared with `reset()`
+timings = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+counters = Counter()
+# stage name -> pstats.Stats summed over all calls, rendered by report()
+profiles = {}
+memory = {}
+
+# stages named here are run under cProfile / tracemalloc
+profile_stages = set()
+trace_memory_stages = set()
+profiler_active = False
+counters_lock = threading.Lock()
+
+
+def reset():
+    timings.clear()
+    counters.clear()
+    profiles.clear()
+    memory.clear()
+
+
+def count(name, n=1):
+    with counters_lock:
+        counters[name] += n
+
+
+class stage(contextlib.ContextDecorator):
+    """Time a named pipeline stage, either as a context manager
+
+        with profiling.stage('parse_omop'):
+            ...
+
+    or as a decorator (`@profiling.stage('parse_omop')`). Stages listed in
+    `profile_stages` or `trace_memory_stages` (or opened with `profile=True` /
+    `trace_memory=True`) are also run under cProfile / tracemalloc.
+    """
+    def __init__(self, name, profile=False, trace_memory=False):
+        self.name = name
+        self.profile = profile
+        self.trace_memory = trace_memory
+        # decorated functions share one stage object, possibly across threads
+        self.local = threading.local()
+
+    @property
+    def frames(self):
+        if not hasattr(self.local, 'frames'):
+            self.local.frames = []
+        return self.local.frames
+
+    def __enter__(self):
+        global profiler_active
+        profiler = None
+        if (self.profile or self.name in profile_stages) and not profiler_active:
+            # nested stages are covered by the outer profile
+            profiler = cProfile.Profile()
+            profiler_active = True
+        tracing = False
+        if (self.trace_memory or self.name in trace_memory_stages) and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracing = True
+        self.frames.append((time.perf_counter(), profiler, tracing))
+        if profiler:
+            profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global profiler_active
+        start, profiler, tracing = self.frames.pop()
+        if profiler:
+            profiler.disable()
+            profiler_active = False
+            with counters_lock:
+                if self.name in profiles:
+                    profiles[self.name].add(profiler)
+                else:
+                    profiles[self.name] = pstats.Stats(profiler)
+        with counters_lock:
+            timing = timings[self.name]
+            timing['calls'] += 1
+            timing['seconds'] += time.perf_counter() - start
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory[self.name] = max(memory.get(self.name, 0), peak)
+        return False
+
+
+def render_profile(stats):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(20)
+    return stream.getvalue()
+
+
+def report():
+    """Machine readable summary of the current run."""
+    return {
+        'stages': {name: dict(timing) for name, timing in timings.items()},
+        'counters': dict(counters),
+        'peak_memory_bytes': dict(memory),
+        'profiles': {name: render_profile(stats) for name, stats in profiles.items()},
+    }
+
+
+def write_report(filename):
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--profile',
+        help='Write a per-stage timing report to this file',
+        default='',
+    )
+    parser.add_argument(
+        '--cprofile-stage',
+        help='Run the named stage under cProfile (can be repeated)',
+        action='append',
+        default=[],
+    )
+    parser.add_argument(
+        '--trace-memory-stage',
+        help='Record peak memory of the named stage with tracemalloc (can be repeated)',
+        action='append',
+        default=[],
+    )
+
+
+def configure(args):
+    reset()
+    profile_stages.update(args.cprofile_stage)
+    trace_memory_stages.update(args.trace_memory_stage)
+
+
+def finish(args):
+    if args.profile:
+        write_report(args.profile)
@@ -0,0 +1,445 @@
+import argparse
+import bisect
+from collections import Counter
+import csv
+import glob
+import json
+import logging
+import os
+import pickle
+import shutil
+import socket
+import sys
+import time
+import uuid
+
+import fhir_analyze
+import omop_analyze
+from pipeline import load_aou_analysis
+import profiling
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'queue',
+        help='Work queue directory on a filesystem shared by all workers',
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    plan_parser = commands.add_parser('plan', help='Partition the cohort into shards')
+    plan_parser.add_argument(
+        '-f',
+        '--fhir-path',
+        help='Directory containing subdirectories for each patient',
+        default=None,
+    )
+    plan_parser.add_argument(
+        '-o',
+        '--omop-path',
+        help='Directory containing omop csv files',
+        default=None,
+    )
+    plan_parser.add_argument(
+        '-n',
+        '--shards',
+        help='Number of shards',
+        default=16,
+        type=int,
+    )
+
+    work_parser = commands.add_parser('work', help='Claim and process shards until none are left')
+    work_parser.add_argument(
+        '-c',
+        '--concept-path',
+        help='Directory containing VOCABULARY.csv and the CONCEPT csv files',
+        default='.',
+    )
+    work_parser.add_argument(
+        '--requeue-after',
+        help='Return shards claimed longer than this many seconds ago to the queue first',
+        default=None,
+        type=float,
+    )
+
+    reduce_parser = commands.add_parser('reduce', help='Combine the partial results of all shards')
+    reduce_parser.add_argument(
+        '-c',
+        '--concept-path',
+        help='Directory containing VOCABULARY.csv and the CONCEPT csv files',
+        default='.',
+    )
+    reduce_parser.add_argument(
+        '-b',
+        '--bin-size',
+        help='Histogram bin size, as for fhir_analyze',
+        default=5,
+        type=int,
+    )
+
+    return parser.parse_args()
+
+
+# Work queue. A shard is a json file that moves from todo/ to claimed/ with an
+# atomic rename, so exactly one worker gets it, and is finished by writing
+# partials/<shard>.pickle. Shards and partials carry the id of the plan they
+# belong to, so a partial left over from an earlier plan is never reduced.
+
+def queue_path(queue, *parts):
+    return os.path.join(queue, *parts)
+
+
+def numeric_person_id(person_id):
+    try:
+        return int(person_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def omop_ranges(person_ids, shards):
+    """Split the numeric person id space into `shards` ranges holding about
+    the same number of `person_ids` each. The first and last range are open
+    ended, so OMOP people without S4S data still land in a shard.
+    """
+    ids = sorted(filter(lambda i: i is not None, map(numeric_person_id, person_ids)))
+    bounds = [0]
+    for i in range(1, shards):
+        bounds.append(max(bounds[-1], ids[i * len(ids) // shards]) if ids else bounds[-1])
+    bounds.append(sys.maxsize)
+    return [[start, stop] for start, stop in zip(bounds, bounds[1:])]
+
+
+def omop_person_ids(omop_path, extension='csv'):
+    person_ids = set()
+    for filename in glob.glob(os.path.join(omop_path, '*.{}'.format(extension))):
+        with open(filename, encoding='utf8', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, None)
+            if not header or 'person_id' not in header:
+                continue
+            person_column = header.index('person_id')
+            person_ids.update(row[person_column] for row in reader if len(row) > person_column)
+    return person_ids
+
+
+def shard_for_person(person_id, ranges):
+    """Index of the range in `ranges` holding `person_id`. Rows whose
+    person_id is missing or not numeric go to the last shard, so every OMOP row
+    is counted by exactly one shard.
+    """
+    person_id = numeric_person_id(person_id)
+    if person_id is None or person_id < ranges[0][0]:
+        return len(ranges) - 1
+    return bisect.bisect_right([start for start, stop in ranges], person_id) - 1
+
+
+def split_omop(queue, omop_path, ranges, extension='csv'):
+    """Copy the rows of every OMOP csv into `omop/<shard>/` in the queue, by
+    the person range of each shard, so each worker reads only its own rows.
+    Every shard gets every csv, with just the header if it has no rows.
+    """
+    directories = [queue_path(queue, 'omop', '{:05d}'.format(i)) for i in range(len(ranges))]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    for filename in omop_analyze.csv_filenames(omop_path, extension):
+        with open(os.path.join(omop_path, filename), encoding='utf8', newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            header = next(reader, None)
+            outputs = [
+                open(os.path.join(directory, filename), 'w', encoding='utf8', newline='')
+                for directory in directories
+            ]
+            try:
+                writers = [csv.writer(output) for output in outputs]
+                if header is None:
+                    continue
+                for writer in writers:
+                    writer.writerow(header)
+                person_column = header.index('person_id') if 'person_id' in header else None
+                for row in reader:
+                    person_id = None
+                    if person_column is not None and person_column < len(row):
+                        person_id = row[person_column]
+                    writers[shard_for_person(person_id, ranges)].writerow(row)
+            finally:
+                for output in outputs:
+                    output.close()
+    return [os.path.abspath(directory) for directory in directories]
+
+
+def plan(queue, fhir_path=None, omop_path=None, shards=16):
+    """Partition participant directories and OMOP person id ranges into
+    `shards` shards and queue them. Participants keep their directory order
+    across shards, so merging partials in shard order sees them in the same
+    order a single machine would. The OMOP rows are split by person range
+    here, once, rather than by every worker. Planning again discards whatever
+    an earlier plan left in the queue.
+    """
+    for name in ['todo', 'claimed', 'partials']:
+        os.makedirs(queue_path(queue, name), exist_ok=True)
+        for filename in os.listdir(queue_path(queue, name)):
+            os.remove(queue_path(queue, name, filename))
+    shutil.rmtree(queue_path(queue, 'omop'), ignore_errors=True)
+    plan_id = uuid.uuid4().hex
+    participants = []
+    if fhir_path:
+        participants = [
+            [person_id, os.path.relpath(directory, fhir_path)]
+            for person_id, directory in fhir_analyze.participant_directories(fhir_path)
+        ]
+    if participants:
+        ranges = omop_ranges([person_id for person_id, directory in participants], shards)
+    elif omop_path:
+        ranges = omop_ranges(omop_person_ids(omop_path), shards)
+    else:
+        ranges = omop_ranges([], shards)
+    omop_paths = [None] * shards
+    if omop_path:
+        omop_paths = split_omop(queue, omop_path, ranges)
+    with open(queue_path(queue, 'plan.json'), 'w') as f:
+        json.dump({
+            'fhir_path': fhir_path and os.path.abspath(fhir_path),
+            'omop_path': omop_path and os.path.abspath(omop_path),
+            'shards': shards,
+            'plan': plan_id,
+        }, f)
+    for i in range(shards):
+        shard = {
+            'plan': plan_id,
+            'shard': i,
+            'participants': participants[i * len(participants) // shards:(i + 1) * len(participants) // shards],
+            'person_range': ranges[i],
+            'omop_path': omop_paths[i],
+        }
+        with open(queue_path(queue, 'todo', '{:05d}.json'.format(i)), 'w') as f:
+            json.dump(shard, f)
+    return shards
+
+
+def claim(queue):
+    """Claim a queued shard, or return None when the queue is empty."""
+    for name in sorted(os.listdir(queue_path(queue, 'todo'))):
+        todo = queue_path(queue, 'todo', name)
+        claimed = queue_path(queue, 'claimed', name)
+        try:
+            # rename keeps the mtime, so mark the claim time first: a shard
+            # never shows up in claimed/ with its plan time for requeue_stale
+            os.utime(todo)
+            os.rename(todo, claimed)
+        except FileNotFoundError:
+            continue  # another worker was faster
+        with open(claimed) as f:
+            return json.load(f)
+    return None
+
+
+def current_plan(queue):
+    with open(queue_path(queue, 'plan.json')) as f:
+        return json.load(f)['plan']
+
+
+def complete(queue, shard, partial):
+    name = '{:05d}'.format(shard['shard'])
+    if current_plan(queue) != shard['plan']:
+        logging.warning('Dropping shard {} of a plan that was replaced'.format(shard['shard']))
+        return
+    path = queue_path(queue, 'partials', name + '.pickle')
+    temporary = '{}.{}-{}.tmp'.format(path, socket.gethostname(), os.getpid())
+    with open(temporary, 'wb') as f:
+        pickle.dump(partial, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+    try:
+        os.remove(queue_path(queue, 'claimed', name + '.json'))
+    except FileNotFoundError:
+        pass  # requeued as stale meanwhile, the rerun will overwrite the same partial
+
+
+def requeue_stale(queue, seconds):
+    """Return shards claimed more than `seconds` ago (e.g. by a worker that
+    died) to the queue. A shard finished twice just overwrites its partial.
+    """
+    requeued = 0
+    now = time.time()
+    for name in os.listdir(queue_path(queue, 'claimed')):
+        claimed = queue_path(queue, 'claimed', name)
+        try:
+            if now - os.stat(claimed).st_mtime < seconds:
+                continue
+            os.rename(claimed, queue_path(queue, 'todo', name))
+        except FileNotFoundError:
+            continue  # finished or requeued meanwhile
+        requeued += 1
+    return requeued
+
+
+# Partial results, all of which merge by addition.
+
+def merge_counters(total, partial):
+    # {key: Counter} += {key: Counter}
+    for key, counter in partial.items():
+        total.setdefault(key, Counter()).update(counter)
+    return total
+
+
+@profiling.stage('process_shard')
+def process_shard(shard, fhir_path, omop_path, aou_analysis):
+    partial = {
+        'plan': shard['plan'],
+        'fhir_counts': {},
+        'fhir_people': {},
+        'code_system_counts': {},
+        'coding_counts': None,
+        'extension_profile': None,
+        'omop_pairs': {},
+        'omop_people': {},
+        'unknown_systems': Counter(),
+    }
+    # unknown systems seen while processing this shard only
+    fhir_analyze.vocabulary_resolver.unknown.clear()
+    if fhir_path:
+        fhir_people = {}
+        for person_id, directory in shard['participants']:
+            directory = os.path.join(fhir_path, directory)
+            base_uri, fhir_people[person_id] = fhir_analyze.data_in_directory(directory)
+            for type_, uniques in fhir_analyze.unique_resource_ids(fhir_people[person_id]).items():
+                # histogram of per patient counts, enough for fhir_analyze.main's summary
+                partial['fhir_counts'].setdefault(base_uri, {}).setdefault(type_, Counter())[len(uniques)] += 1
+        partial['fhir_people'] = {
+            person_id: {category: len(entries) for category, entries in resources.items()}
+            for person_id, resources in fhir_people.items()
+        }
+        partial['code_system_counts'] = aou_analysis.code_system_counts(fhir_people)
+        partial['coding_counts'] = aou_analysis.coding_counts_partial(fhir_people)
+        partial['extension_profile'] = aou_analysis.extension_profile(fhir_people)
+    if omop_path:
+        # just this shard's rows, split out by plan
+        omop_people, csvs = omop_analyze.parse_omop(omop_path)
+        partial['omop_people'] = {
+            person_id: {table: len(rows) for table, rows in tables.items()}
+            for person_id, tables in omop_people.items()
+        }
+        partial['omop_pairs'] = aou_analysis.omop_concept_pair_counts(omop_people)
+    partial['unknown_systems'].update(fhir_analyze.vocabulary_resolver.unknown)
+    return partial
+
+
+def work(queue, concept_path='.', requeue_after=None):
+    """Claim and process shards until the queue is empty. Returns the number
+    of shards processed by this worker.
+    """
+    with open(queue_path(queue, 'plan.json')) as f:
+        settings = json.load(f)
+    if requeue_after is not None:
+        requeue_stale(queue, requeue_after)
+    aou_analysis = load_aou_analysis(concept_path)
+    processed = 0
+    while True:
+        shard = claim(queue)
+        if shard is None:
+            return processed
+        logging.debug('Processing shard {}'.format(shard['shard']))
+        partial = process_shard(shard, settings['fhir_path'], shard['omop_path'], aou_analysis)
+        complete(queue, shard, partial)
+        processed += 1
+
+
+def load_partials(queue):
+    with open(queue_path(queue, 'plan.json')) as f:
+        settings = json.load(f)
+    missing = [
+        i for i in range(settings['shards'])
+        if not os.path.exists(queue_path(queue, 'partials', '{:05d}.pickle'.format(i)))
+    ]
+    if missing:
+        raise ValueError('{} of {} shards are not finished, e.g. shard {}'.format(
+            len(missing), settings['shards'], missing[0]
+        ))
+    for i in range(settings['shards']):
+        with open(queue_path(queue, 'partials', '{:05d}.pickle'.format(i)), 'rb') as f:
+            partial = pickle.load(f)
+        if partial.get('plan') != settings['plan']:
+            raise ValueError('shard {} was finished for an earlier plan, run work again'.format(i))
+        yield partial
+
+
+@profiling.stage('reduce_partials')
+def reduce_partials(queue, aou_analysis, bin_size=5):
+    """Merge the partials of all shards, in shard order, into the results of
+    `fhir_analyze.main` and the `aou_analysis` reports.
+    """
+    fhir_counts = {}
+    fhir_people = {}
+    system_counts = {}
+    codings = None
+    extensions = None
+    omop_pairs = {}
+    omop_people = {}
+    for partial in load_partials(queue):
+        for base_uri, type_counts in partial['fhir_counts'].items():
+            merge_counters(fhir_counts.setdefault(base_uri, {}), type_counts)
+        fhir_people.update(partial['fhir_people'])
+        merge_counters(system_counts, partial['code_system_counts'])
+        if partial['coding_counts'] is not None:
+            if codings is None:
+                codings = partial['coding_counts']
+            else:
+                aou_analysis.merge_coding_counts(codings, partial['coding_counts'])
+        if partial['extension_profile'] is not None:
+            if extensions is None:
+                extensions = partial['extension_profile']
+            else:
+                extensions.merge(partial['extension_profile'])
+        merge_counters(omop_pairs, partial['omop_pairs'])
+        omop_people.update(partial['omop_people'])
+        fhir_analyze.vocabulary_resolver.unknown.update(partial['unknown_systems'])
+
+    results = {
+        'fhir_analyze': {
+            base_uri: {
+                type_: fhir_analyze.count_summary(sorted(counts.elements()), bin_size)
+                for type_, counts in type_counts.items()
+            }
+            for base_uri, type_counts in fhir_counts.items()
+        },
+        'code_system_counts': system_counts,
+        'omop_system_counts': aou_analysis.omop_system_counts_for_pairs(omop_pairs),
+        'omop_coding_counts': aou_analysis.omop_coding_counts_for_pairs(omop_pairs),
+    }
+    if codings is not None:
+        aou_analysis.concept_table.set_index(['concept_code', 'vocabulary_id',], inplace=True)
+        results['coding_counts'] = aou_analysis.coding_counts_from_partial(codings)
+    if extensions is not None:
+        results['extension_profile'] = extensions.summary()
+    if fhir_people and omop_people:
+        # per patient category sizes stand in for the entries themselves
+        results['compare_per_patient'] = aou_analysis.compare_per_patient(fhir_people, omop_people)
+    return results
+
+
+def main():
+    """Plan, work on or reduce a sharded run over a shared work queue."""
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    if args.command == 'plan':
+        return {'shards': plan(args.queue, args.fhir_path, args.omop_path, args.shards)}
+    if args.command == 'work':
+        return {'processed': work(args.queue, args.concept_path, args.requeue_after)}
+    results = reduce_partials(args.queue, load_aou_analysis(args.concept_path), args.bin_size)
+    fhir_analyze.vocabulary_resolver.report()
+    with open(queue_path(args.queue, 'results.pickle'), 'wb') as f:
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return results['fhir_analyze']
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,148 @@
+from collections import Counter
+import hashlib
+import heapq
+import math
+
+
+def hash64(value):
+    # stable across processes (unlike hash()), so sketches built by different
+    # workers can be merged
+    return int.from_bytes(
+        hashlib.blake2b(str(value).encode('utf8'), digest_size=8).digest(), 'big'
+    )
+
+
+class HyperLogLog:
+    """Approximate distinct counter. With `precision` p it uses 2**p one-byte
+    registers and has a relative standard error of about 1.04 / sqrt(2**p),
+    i.e. ~1.6% for the default p=12 (4 KB per counter).
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    @property
+    def error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def add_hash(self, h):
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge HyperLogLogs of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+
+class HeavyHitters:
+    """Top-k frequent items, as a Misra-Gries summary. Items are counted
+    exactly in a dict until it holds more than `capacity` of them; then the
+    (capacity // 2 + 1)-th largest count is subtracted from every item and the
+    items that drop to zero are forgotten. A count is an undercount by at most
+    `error_bound()`, which never exceeds total / (capacity // 2 + 1), so every
+    item more frequent than that is kept. Distinct items are estimated with a
+    HyperLogLog fed only when an item enters the summary, so an item is hashed
+    once rather than on every add.
+    """
+    def __init__(self, k=20, capacity=1000, precision=10):
+        self.k = k
+        self.capacity = capacity
+        self.precision = precision
+        self.total = 0
+        self.counts = {}
+        # sum of the counts subtracted so far, the largest possible undercount
+        self.error = 0
+        self.distinct = HyperLogLog(precision)
+
+    def add(self, value, count=1):
+        self.total += count
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+            return
+        counts[value] = count
+        self.distinct.add(value)
+        if len(counts) > self.capacity:
+            self.reduce()
+
+    def update(self, values):
+        # count repeats in C first, most streams repeat their items a lot
+        for value, count in Counter(values).items():
+            self.add(value, count)
+
+    def reduce(self):
+        keep = self.capacity // 2
+        counts = self.counts
+        threshold = heapq.nlargest(keep + 1, counts.values())[-1]
+        self.error += threshold
+        self.counts = {
+            value: count - threshold
+            for value, count in counts.items()
+            if count > threshold
+        }
+
+    @property
+    def approximate(self):
+        return self.error > 0
+
+    def most_common(self, n=None):
+        return heapq.nlargest(min(n or self.k, self.k), self.counts.items(), key=lambda item: item[1])
+
+    def error_bound(self):
+        """Maximum undercount of any count, 0 while everything is exact."""
+        return self.error
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge HeavyHitters of different precision')
+        self.total += other.total
+        self.error += other.error
+        counts = self.counts
+        for value, count in other.counts.items():
+            counts[value] = counts.get(value, 0) + count
+        self.distinct.merge(other.distinct)
+        while len(self.counts) > self.capacity:
+            self.reduce()
+        return self
+
+    def copy(self):
+        other = HeavyHitters(self.k, self.capacity, self.precision)
+        other.total = self.total
+        other.error = self.error
+        other.counts = dict(self.counts)
+        other.distinct.registers = bytearray(self.distinct.registers)
+        return other
+
+    def summary(self, n=None):
+        return {
+            'top': self.most_common(n),
+            'total': self.total,
+            'distinct': self.distinct.count() if self.approximate else len(self.counts),
+            'count_error': self.error_bound(),
+            'distinct_relative_error': self.distinct.error if self.approximate else 0,
+        }
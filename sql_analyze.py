@@ -0,0 +1,430 @@
+import argparse
+from collections import Counter
+import csv
+import glob
+import json
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+import fhir_analyze
+import omop_analyze
+
+
+CONCEPT_FILES = ['CONCEPT.csv', 'CONCEPT_CPT4.csv', 'CONCEPT_AOUPPI.csv']
+CONCEPT_COLUMNS = [
+    'concept_id',
+    'concept_name',
+    'domain_id',
+    'vocabulary_id',
+    'concept_class_id',
+    'standard_concept',
+    'concept_code',
+]
+
+BATCH_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS omop_tables (
+    filename TEXT PRIMARY KEY,
+    table_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS concept (
+    concept_id TEXT,
+    concept_name TEXT,
+    domain_id TEXT,
+    vocabulary_id TEXT,
+    concept_class_id TEXT,
+    standard_concept TEXT,
+    concept_code TEXT
+);
+CREATE TABLE IF NOT EXISTS fhir_resource (
+    person_id TEXT,
+    category TEXT,
+    resource_type TEXT,
+    resource_id TEXT
+);
+CREATE TABLE IF NOT EXISTS fhir_category (
+    person_id TEXT,
+    category TEXT
+);
+CREATE TABLE IF NOT EXISTS fhir_coding (
+    person_id TEXT,
+    category TEXT,
+    resource_type TEXT,
+    system TEXT,
+    code TEXT,
+    display TEXT,
+    nested INTEGER
+);
+'''
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--db',
+        help='SQLite database file to load into',
+        default='aou_analysis.sqlite',
+    )
+    parser.add_argument(
+        '-f',
+        '--fhir-path',
+        help='Directory containing subdirectories for each patient',
+        default=None,
+    )
+    parser.add_argument(
+        '-o',
+        '--omop-path',
+        help='Directory containing omop csv files',
+        default=None,
+    )
+    parser.add_argument(
+        '-c',
+        '--concept-path',
+        help='Directory containing the CONCEPT csv files',
+        default=None,
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        help='Show debug messages',
+        action='store_const',
+        dest='log_level',
+        const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+
+    return parser.parse_args()
+
+
+def connect(db_path='aou_analysis.sqlite'):
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    # stored concept ids stay as in the csvs, joins normalize them
+    conn.create_function('normalize_concept_id', 1, normalize_concept_id, deterministic=True)
+    return conn
+
+
+def quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def normalize_concept_id(concept_id):
+    # concept ids sometimes come through as floats, see `omop_concept_lookup`
+    if concept_id is None:
+        return None
+    return concept_id.split('.')[0]
+
+
+def insert_batched(conn, statement, rows):
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(statement, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(statement, batch)
+        total += len(batch)
+    return total
+
+
+def omop_table_name(filename):
+    return 'omop_' + os.path.splitext(os.path.basename(filename))[0]
+
+
+def load_omop_csv(conn, filename, delimiter=','):
+    """Stream one OMOP csv into its own table, one TEXT column per csv column.
+    Values are kept as they are in the csv (e.g. concept ids like "123.0"), so
+    reports key on the same raw values as `aou_analysis`.
+    """
+    table = omop_table_name(filename)
+    with open(filename, encoding='utf8', newline='') as csv_file:
+        reader = csv.reader(csv_file, delimiter=delimiter)
+        header = next(reader, None)
+        if not header:
+            return 0
+
+        def rows():
+            for row in reader:
+                row = row + [None] * (len(header) - len(row))
+                yield row[:len(header)]
+
+        conn.execute('DROP TABLE IF EXISTS {}'.format(quote(table)))
+        conn.execute('CREATE TABLE {} ({})'.format(
+            quote(table), ', '.join('{} TEXT'.format(quote(c)) for c in header)
+        ))
+        count = insert_batched(conn, 'INSERT INTO {} VALUES ({})'.format(
+            quote(table), ', '.join('?' * len(header))
+        ), rows())
+    if 'person_id' in header:
+        conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} (person_id)'.format(
+            quote(table + '_person_id'), quote(table)
+        ))
+    conn.execute(
+        'INSERT OR REPLACE INTO omop_tables VALUES (?, ?)',
+        (os.path.basename(filename), table)
+    )
+    conn.commit()
+    logging.debug('Loaded {} rows from {}'.format(count, filename))
+    return count
+
+
+def load_omop(conn, path=".\\omop\\20190326", extension='csv'):
+    """Load every OMOP csv in `path`, like `omop_analyze.parse_omop` reads them."""
+    total = 0
+    for filename in glob.glob(os.path.join(path, '*.{}'.format(extension))):
+        total += load_omop_csv(conn, filename)
+    print("Loaded {} omop rows".format(total))
+    return total
+
+
+def load_concepts(conn, path='.'):
+    """Load the tab separated CONCEPT tables read by `init_omop_concepts`."""
+    conn.execute('DELETE FROM concept')
+
+    def rows():
+        for filename in CONCEPT_FILES:
+            with open(os.path.join(path, filename), encoding='utf8', newline='') as csv_file:
+                for row in csv.DictReader(csv_file, delimiter="\t"):
+                    yield tuple(row.get(column) for column in CONCEPT_COLUMNS)
+
+    count = insert_batched(conn, 'INSERT INTO concept VALUES ({})'.format(
+        ', '.join('?' * len(CONCEPT_COLUMNS))
+    ), rows())
+    conn.execute('CREATE INDEX IF NOT EXISTS concept_id_idx ON concept (concept_id)')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS concept_code_idx ON concept (concept_code, vocabulary_id)'
+    )
+    conn.commit()
+    return count
+
+
+def coding_rows(person_id, person):
+    """`fhir_analyze.coding_rows`, plus whether each coding came nested in an
+    extra list. `aou_analysis.code_system_counts` skips those.
+    """
+    for category, entries in person.items():
+        for entry in entries:
+            try:
+                fetched = fhir_analyze.fetch_at_path(entry, fhir_analyze.path_for_resource(entry))
+            except KeyError:
+                continue
+            for f in fetched or []:
+                nested = isinstance(f, list)
+                if nested:
+                    if not f:
+                        continue
+                    f = f[0]
+                if isinstance(f, dict):
+                    yield (
+                        person_id,
+                        category,
+                        entry.get('resourceType'),
+                        f.get('system'),
+                        f.get('code'),
+                        f.get('display'),
+                        int(nested),
+                    )
+
+
+def load_fhir(conn, path=".\\fhir\\Participant"):
+    """Flatten every participant's S4S resources into `fhir_resource` and their
+    codings into `fhir_coding`, one participant at a time. `fhir_category`
+    records the categories each participant has, with or without resources.
+    """
+    # recreated rather than emptied, in case the database has an older schema
+    for table in ['fhir_resource', 'fhir_category', 'fhir_coding']:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+    conn.executescript(SCHEMA)
+    people = 0
+    for person_id, base_uri, person in fhir_analyze.iter_participants(path):
+        resources = [
+            (person_id, category, entry.get('resourceType'), entry.get('id'))
+            for category, entries in person.items()
+            for entry in entries
+        ]
+        conn.executemany('INSERT INTO fhir_resource VALUES (?, ?, ?, ?)', resources)
+        conn.executemany(
+            'INSERT INTO fhir_category VALUES (?, ?)',
+            [(person_id, category) for category in person]
+        )
+        conn.executemany(
+            'INSERT INTO fhir_coding VALUES (?, ?, ?, ?, ?, ?, ?)', coding_rows(person_id, person)
+        )
+        people += 1
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS fhir_resource_person_idx ON fhir_resource (person_id)'
+    )
+    conn.commit()
+    print("Loaded {} s4s participants".format(people))
+    return people
+
+
+def omop_tables(conn):
+    return dict(conn.execute('SELECT filename, table_name FROM omop_tables'))
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(quote(table)))]
+
+
+# Reports
+
+def code_system_counts(conn):
+    # Count of code *systems* for each data category, see `aou_analysis.code_system_counts`.
+    # Like it, every category a participant has gets a Counter, and codings
+    # nested in an extra list are not counted.
+    coding_paths = {}
+    for category, in conn.execute(
+        'SELECT category FROM fhir_category GROUP BY category ORDER BY MIN(rowid)'
+    ):
+        coding_paths[category] = Counter()
+    for category, system, count in conn.execute(
+        'SELECT category, system, COUNT(*) FROM fhir_coding WHERE NOT nested GROUP BY category, system'
+    ):
+        coding_paths[category][system] = count
+    return coding_paths
+
+
+def omop_coding_counts(conn):
+    """Same output as `aou_analysis.omop_coding_counts`, with the counting and
+    the concept joins done by the database.
+    """
+    codes = {}
+    standardized_codings = {}
+    for filename, table in omop_tables(conn).items():
+        if filename not in omop_analyze.CODE_COLUMNS:
+            continue
+        columns = table_columns(conn, table)
+        selected = [
+            quote(c) if c in columns else 'NULL' for c in omop_analyze.CODE_COLUMNS[filename]
+        ]
+        query = '''
+            SELECT
+                raw.c0, raw.c1, raw.n,
+                c0.vocabulary_id, c0.concept_code, c0.concept_name,
+                c1.vocabulary_id, c1.concept_code, c1.concept_name
+            FROM (
+                SELECT {0} AS c0, {1} AS c1, COUNT(*) AS n
+                FROM {2} GROUP BY 1, 2
+            ) AS raw
+            LEFT JOIN concept AS c0 ON c0.concept_id = normalize_concept_id(raw.c0)
+            LEFT JOIN concept AS c1 ON c1.concept_id = normalize_concept_id(raw.c1)
+        '''.format(selected[0], selected[1], quote(table))
+        codes[filename] = Counter()
+        for row in conn.execute(query):
+            raw = " ".join(value if value is not None else 'None' for value in row[:2])
+            codes[filename][raw] += row[2]
+            if row[3] is None or row[6] is None:
+                standardized_codings[raw] = [{}, {}]
+            else:
+                standardized_codings[raw] = [
+                    {'system': row[3], 'coding': row[4], 'name': row[5]},
+                    {'system': row[6], 'coding': row[7], 'name': row[8]},
+                ]
+    return codes, standardized_codings
+
+
+def omop_status_counts(conn, status_flags):
+    """Distribution of each status column per OMOP csv, see
+    `aou_analysis.omop_status_counts`. `*_concept_id` values are replaced by
+    their code, vocabulary and name.
+    """
+    omop_status_counters = {}
+    for filename, table in omop_tables(conn).items():
+        omop_status_counters[filename] = {}
+        columns = table_columns(conn, table)
+        for column in status_flags:
+            if column not in columns:
+                continue
+            counter = omop_status_counters[filename][column] = Counter()
+            if column.endswith('concept_id'):
+                query = '''
+                    SELECT raw.value, raw.n, c.vocabulary_id, c.concept_code, c.concept_name
+                    FROM (SELECT {0} AS value, COUNT(*) AS n FROM {1} GROUP BY 1) AS raw
+                    LEFT JOIN concept AS c ON c.concept_id = normalize_concept_id(raw.value)
+                '''.format(quote(column), quote(table))
+                for value, count, vocabulary_id, concept_code, concept_name in conn.execute(query):
+                    if concept_name is not None:
+                        value = " ".join([concept_code, vocabulary_id, concept_name])
+                    counter[value] += count
+            else:
+                query = 'SELECT {0}, COUNT(*) FROM {1} GROUP BY 1'.format(
+                    quote(column), quote(table)
+                )
+                for value, count in conn.execute(query):
+                    counter[value] += count
+    return omop_status_counters
+
+
+def fhir_counts_per_patient(conn):
+    return dict(conn.execute(
+        'SELECT person_id, COUNT(*) FROM fhir_resource GROUP BY person_id'
+    ))
+
+
+def omop_counts_per_patient(conn):
+    counts = Counter()
+    for filename, table in omop_tables(conn).items():
+        if 'person_id' not in table_columns(conn, table):
+            continue
+        counts.update(dict(conn.execute(
+            'SELECT person_id, COUNT(*) FROM {} GROUP BY person_id'.format(quote(table))
+        )))
+    return counts
+
+
+def compare_per_patient(conn):
+    """Total FHIR resources next to total OMOP rows for every participant
+    present in both sources, as a DataFrame shaped like
+    `aou_analysis.compare_per_patient` (FHIR and OMOP columns, sorted by FHIR,
+    indexed by 'Patient'). Unlike the in-memory version, the totals include
+    every category, not only those present for all participants.
+    """
+    fhir_counts = fhir_counts_per_patient(conn)
+    omop_counts = omop_counts_per_patient(conn)
+    compare_df = pd.DataFrame(
+        [
+            (count, omop_counts[person_id])
+            for person_id, count in fhir_counts.items()
+            if person_id in omop_counts
+        ],
+        columns=['FHIR', 'OMOP'],
+    )
+    compare_df.sort_values('FHIR', ascending=False, inplace=True)
+    compare_df.index = pd.RangeIndex(len(compare_df))
+    compare_df.index.name = 'Patient'
+    return compare_df
+
+
+def main():
+    """Load whichever sources were given into the database and print a
+    summary of what it contains.
+    """
+    args = parse_arguments()
+    logging.basicConfig(level=args.log_level)
+    conn = connect(args.db)
+    if args.concept_path:
+        load_concepts(conn, args.concept_path)
+    if args.omop_path:
+        load_omop(conn, args.omop_path)
+    if args.fhir_path:
+        load_fhir(conn, args.fhir_path)
+    summary = {
+        'omop_tables': omop_tables(conn),
+        'concepts': conn.execute('SELECT COUNT(*) FROM concept').fetchone()[0],
+        'fhir_resources': conn.execute('SELECT COUNT(*) FROM fhir_resource').fetchone()[0],
+        'fhir_codings': conn.execute('SELECT COUNT(*) FROM fhir_coding').fetchone()[0],
+    }
+    conn.close()
+    return summary
+
+
+if __name__ == '__main__':
+    print(json.dumps(main(), indent=2, sort_keys=True))
@@ -0,0 +1,271 @@
+import argparse
+import csv
+import json
+import os
+import random
+
+from fhir_analyze import FILE_TYPE_MAPPING
+
+
+BASE_URI = 'https://fhir.example.org/api/FHIR/DSTU2/'
+
+# FHIR system and OMOP vocabulary used for the codes of each resource type
+RESOURCE_VOCABULARIES = {
+    'AllergyIntolerance': ('http://www.nlm.nih.gov/research/umls/rxnorm', 'RxNorm'),
+    'Condition': ('http://snomed.info/sct', 'SNOMED'),
+    'DocumentReference': ('http://loinc.org', 'LOINC'),
+    'Immunization': ('http://hl7.org/fhir/sid/cvx', 'CVX'),
+    'MedicationOrder': ('http://www.nlm.nih.gov/research/umls/rxnorm', 'RxNorm'),
+    'MedicationStatement': ('http://www.nlm.nih.gov/research/umls/rxnorm', 'RxNorm'),
+    'Observation': ('http://loinc.org', 'LOINC'),
+    'Procedure': ('http://www.ama-assn.org/go/cpt', 'CPT4'),
+}
+
+# translation codes added to some resources so synonym sets get built
+TRANSLATION_VOCABULARIES = {
+    'Condition': ('http://hl7.org/fhir/sid/icd-10-cm', 'ICD10CM'),
+}
+
+CODE_PATHS = {
+    'AllergyIntolerance': 'substance',
+    'Condition': 'code',
+    'DocumentReference': 'class',
+    'Immunization': 'vaccineCode',
+    'MedicationOrder': 'medicationCodeableConcept',
+    'MedicationStatement': 'medicationCodeableConcept',
+    'Observation': 'code',
+    'Procedure': 'code',
+}
+
+OMOP_TABLES = {
+    'condition.csv': ('condition', 'SNOMED', 'ICD10CM'),
+    'observation.csv': ('observation', 'LOINC', 'LOINC'),
+    'procedure.csv': ('procedure', 'CPT4', 'CPT4'),
+    'drug.csv': ('drug', 'RxNorm', 'RxNorm'),
+    'measurement.csv': ('measurement', 'LOINC', 'LOINC'),
+}
+
+VOCABULARIES = ['SNOMED', 'LOINC', 'RxNorm', 'CVX', 'CPT4', 'ICD10CM']
+
+CONCEPT_COLUMNS = [
+    'concept_id',
+    'concept_name',
+    'domain_id',
+    'vocabulary_id',
+    'concept_class_id',
+    'standard_concept',
+    'concept_code',
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o',
+        '--out',
+        help='Directory to write the synthetic data set to',
+        default='synthetic',
+    )
+    add_scale_arguments(parser)
+
+    return parser.parse_args()
+
+
+def add_scale_arguments(parser):
+    parser.add_argument(
+        '-n',
+        '--participants',
+        help='Number of synthetic participants',
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        '-r',
+        '--resources',
+        help='Resources per participant and resource type',
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        '-v',
+        '--vocabulary-size',
+        help='Number of distinct codes per vocabulary',
+        default=500,
+        type=int,
+    )
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='Random seed',
+        default=0,
+        type=int,
+    )
+
+
+def concept_code(vocabulary_id, i):
+    return '{}-{}'.format(vocabulary_id, i)
+
+
+def concept_id(vocabulary_id, i, vocabulary_size):
+    return str(1000000 + VOCABULARIES.index(vocabulary_id) * vocabulary_size + i)
+
+
+def write_tsv(filename, columns, rows):
+    with open(filename, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def generate_concepts(path, vocabulary_size=500):
+    """Write VOCABULARY.csv and the three CONCEPT tables `init_omop_concepts`
+    reads, with `vocabulary_size` concepts per vocabulary.
+    """
+    os.makedirs(path, exist_ok=True)
+    write_tsv(
+        os.path.join(path, 'VOCABULARY.csv'),
+        ['vocabulary_id', 'vocabulary_name'],
+        [(v, v) for v in VOCABULARIES],
+    )
+    rows = {'CONCEPT.csv': [], 'CONCEPT_CPT4.csv': [], 'CONCEPT_AOUPPI.csv': []}
+    for vocabulary_id in VOCABULARIES:
+        filename = 'CONCEPT_CPT4.csv' if vocabulary_id == 'CPT4' else 'CONCEPT.csv'
+        for i in range(vocabulary_size):
+            rows[filename].append((
+                concept_id(vocabulary_id, i, vocabulary_size),
+                '{} concept {}'.format(vocabulary_id, i),
+                'Synthetic',
+                vocabulary_id,
+                'Synthetic',
+                'S',
+                concept_code(vocabulary_id, i),
+            ))
+    for filename, concept_rows in rows.items():
+        write_tsv(os.path.join(path, filename), CONCEPT_COLUMNS, concept_rows)
+
+
+def coding(rng, resource_type, vocabulary_size):
+    system, vocabulary_id = RESOURCE_VOCABULARIES[resource_type]
+    # skewed towards low codes so there are common and rare codings
+    i = min(int(rng.expovariate(10 / vocabulary_size)), vocabulary_size - 1)
+    codings = [{
+        'system': system,
+        'code': concept_code(vocabulary_id, i),
+        'display': '{} concept {}'.format(vocabulary_id, i),
+    }]
+    if resource_type in TRANSLATION_VOCABULARIES and rng.random() < 0.5:
+        system, vocabulary_id = TRANSLATION_VOCABULARIES[resource_type]
+        codings.append({
+            'system': system,
+            'code': concept_code(vocabulary_id, i),
+        })
+    return codings
+
+
+def resource(rng, resource_type, person_id, n, vocabulary_size):
+    resource = {
+        'resourceType': resource_type,
+        'id': '{}-{}-{}'.format(resource_type, person_id, n),
+    }
+    if resource_type in CODE_PATHS:
+        resource[CODE_PATHS[resource_type]] = {
+            'coding': coding(rng, resource_type, vocabulary_size)
+        }
+    if resource_type == 'Condition':
+        resource['clinicalStatus'] = rng.choice(['active', 'resolved', 'remission'])
+        resource['verificationStatus'] = 'confirmed'
+    elif resource_type == 'Observation':
+        resource['status'] = 'final'
+        resource['valueQuantity'] = {'value': round(rng.uniform(0, 200), 1), 'unit': 'mg/dL'}
+    if rng.random() < 0.2:
+        resource['extension'] = [{
+            'url': 'http://example.org/fhir/extension/{}'.format(rng.randint(0, 4)),
+            'valueString': rng.choice(['a', 'b', 'c']),
+        }]
+    return resource
+
+
+def generate_participant(path, person_id, rng, resources=10, vocabulary_size=500):
+    """Write one participant tree in the layout `find_resource_files` reads:
+    `<path>/P<person_id>/SyncForScience/<server>/log.json` and one bundle per
+    `FILE_TYPE_MAPPING` type.
+    """
+    server_dir = os.path.join(path, 'P{}'.format(person_id), 'SyncForScience', 'server')
+    os.makedirs(server_dir, exist_ok=True)
+    queries = []
+    for type_, resource_type in sorted(FILE_TYPE_MAPPING.items()):
+        filename = '{}.json'.format(type_)
+        if type_ == 'PATIENT_DEMOGRAPHICS':
+            bundle = {'resourceType': 'Patient', 'id': str(person_id), 'gender': 'unknown'}
+            request = '{}Patient/{}'.format(BASE_URI, person_id)
+        else:
+            bundle = {'resourceType': 'Bundle', 'type': 'searchset'}
+            # types without a code path (see `path_for_resource`) are left
+            # empty so the coding reports can run over every bundle
+            if resource_type in CODE_PATHS:
+                bundle['entry'] = [
+                    {'resource': resource(rng, resource_type, person_id, n, vocabulary_size)}
+                    for n in range(resources)
+                ]
+            request = '{}{}?patient={}'.format(BASE_URI, resource_type, person_id)
+        with open(os.path.join(server_dir, filename), 'w') as f:
+            json.dump(bundle, f)
+        queries.append({'status': 200, 'response': filename, 'request': request})
+    with open(os.path.join(server_dir, 'log.json'), 'w') as f:
+        json.dump({'query': queries}, f)
+
+
+def generate_s4s(path, participants=100, resources=10, vocabulary_size=500, seed=0):
+    rng = random.Random(seed)
+    for person_id in range(participants):
+        generate_participant(path, person_id, rng, resources, vocabulary_size)
+
+
+def generate_omop(path, participants=100, resources=10, vocabulary_size=500, seed=0):
+    """Write comma separated OMOP csvs for the same participants as
+    `generate_s4s`, `resources` rows per participant and table.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for filename, (domain, vocabulary_id, source_vocabulary_id) in sorted(OMOP_TABLES.items()):
+        columns = [
+            '{}_id'.format(domain),
+            'person_id',
+            '{}_concept_id'.format(domain),
+            '{}_source_concept_id'.format(domain),
+            '{}_type_concept_id'.format(domain),
+        ]
+        with open(os.path.join(path, filename), 'w', encoding='utf8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            row_id = 0
+            for person_id in range(participants):
+                for n in range(resources):
+                    i = min(int(rng.expovariate(10 / vocabulary_size)), vocabulary_size - 1)
+                    writer.writerow([
+                        row_id,
+                        person_id,
+                        concept_id(vocabulary_id, i, vocabulary_size),
+                        concept_id(source_vocabulary_id, i, vocabulary_size),
+                        '' if rng.random() < 0.1 else '32817',
+                    ])
+                    row_id += 1
+
+
+def generate(path, participants=100, resources=10, vocabulary_size=500, seed=0):
+    """Write a complete synthetic data set under `path`: `fhir/Participant`,
+    `omop` and the concept tables in `path` itself.
+    """
+    generate_concepts(path, vocabulary_size)
+    generate_s4s(os.path.join(path, 'fhir', 'Participant'), participants, resources, vocabulary_size, seed)
+    generate_omop(os.path.join(path, 'omop'), participants, resources, vocabulary_size, seed)
+
+
+def main():
+    args = parse_arguments()
+    generate(args.out, args.participants, args.resources, args.vocabulary_size, args.seed)
+    return os.path.abspath(args.out)
+
+
+if __name__ == '__main__':
+    print(main())